@@ -0,0 +1,208 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+from typing import Awaitable, Callable, Optional
+
+import httpx
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+async def run_load(name: str,
+                   send: Callable[[int], Awaitable[httpx.Response]],
+                   total: int,
+                   concurrency: int) -> dict:
+    """ Issue total requests with at most concurrency in flight, returning throughput and latency percentiles. """
+    latencies = []
+    errors = 0
+    next_request = 0
+
+    async def worker():
+        nonlocal next_request, errors
+        while next_request < total:
+            i = next_request
+            next_request += 1
+            start = time.perf_counter()
+            try:
+                response = await send(i)
+                response.raise_for_status()
+            except httpx.HTTPError as e:
+                errors += 1
+                if errors == 1:
+                    print(f"{name}: first error: {e}")
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(min(concurrency, total))])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "scenario": name,
+        "requests": total,
+        "errors": errors,
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 3),
+        "throughput": round(len(latencies) / elapsed, 1) if elapsed > 0 else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1)
+    }
+
+
+def configure_environment(openai_url: str, facepunch_url: str, api_key: str, dimensions: Optional[int] = None,
+                          neighbour_index_path: str = "", lexical_index_path: str = ""):
+    """ Point the app at the fakes and turn off every on-disk cache, before anything reads the environment.
+    The neighbour table and lexical index only exist with a path, so runs that use them give them scratch files. """
+    os.environ.update({
+        "API_KEY": api_key,
+        "OPENAI_KEY": "benchmark",
+        "OPENAI_BASE_URL": f"{openai_url}/v1",
+        "FACEPUNCH_BASE_URL": facepunch_url,
+        "EMBEDDING_MODEL": "text-embedding-3-small",
+        "EMBEDDING_DIMENSIONS": str(dimensions or ""),
+        "VECTOR_BACKEND": "pinecone",
+        "EMBEDDING_CACHE_PATH": "",
+        "TIMESTAMP_INDEX_PATH": "",
+        "LEXICAL_INDEX_PATH": lexical_index_path,
+        "NEIGHBOUR_INDEX_PATH": neighbour_index_path,
+        "EMBEDDING_STORE_PATH": "",
+        "INDEX_CHECKPOINT_PATH": ""
+    })
+
+
+async def run_benchmarks(args) -> list[dict]:
+    from benchmarks import (BackgroundServer, FakePineconeIndex, Latency, SyntheticCatalogue, create_facepunch_app,
+                            create_openai_app, seeded_embedding)
+
+    catalogue = SyntheticCatalogue(args.catalogue, seed=args.seed)
+    openai_latency = Latency(args.openai_latency, args.jitter, seed=args.seed)
+    pinecone_latency = Latency(args.pinecone_latency, args.jitter, seed=args.seed + 1)
+    facepunch_latency = Latency(args.facepunch_latency, args.jitter, seed=args.seed + 2)
+    api_key = "benchmark"
+
+    with BackgroundServer(create_openai_app(openai_latency)) as openai_server, \
+            BackgroundServer(create_facepunch_app(catalogue, facepunch_latency)) as facepunch_server, \
+            tempfile.TemporaryDirectory() as scratch:
+        neighbour_index_path = os.path.join(scratch, "neighbours.npz") if "suggest" in args.scenarios else ""
+        lexical_index_path = os.path.join(scratch, "lexical.json") if args.search_mode != "semantic" else ""
+        configure_environment(openai_server.url, facepunch_server.url, api_key, args.dimensions,
+                              neighbour_index_path, lexical_index_path)
+
+        from main import app
+        from dependencies import get_lexical_index, get_pinecone_service, get_pinecone_service_async
+        from services import PineconeService, TimestampIndex
+        from utils import get_embed_string, get_pinecone_vector_from_package
+
+        index = FakePineconeIndex(pinecone_latency)
+        for i in range(0, len(catalogue.packages), 500):
+            index.seed([get_pinecone_vector_from_package(
+                seeded_embedding(get_embed_string(package), dimensions=args.dimensions).tolist(), package)
+                for package in catalogue.packages[i:i+500]])
+        pinecone_service = PineconeService(api_key="", index_name="", timestamp_index=TimestampIndex(), index=index)
+
+        async def get_fake_pinecone_service_async():
+            return pinecone_service
+        app.dependency_overrides[get_pinecone_service] = lambda: pinecone_service
+        app.dependency_overrides[get_pinecone_service_async] = get_fake_pinecone_service_async
+
+        results = []
+        with BackgroundServer(app) as app_server:
+            limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+            async with httpx.AsyncClient(base_url=app_server.url, headers={"X-API-Key": api_key},
+                                         limits=limits, timeout=httpx.Timeout(300.0)) as client:
+                if "search" in args.scenarios:
+                    queries = catalogue.queries(args.queries, seed=args.seed)
+                    picks = random.Random(args.seed)
+                    order = [picks.choice(queries) for _ in range(args.warmup + args.requests)]
+
+                    async def search(i: int) -> httpx.Response:
+                        return await client.post("/search/", json={"query": order[i], "take": 10, "mode": args.search_mode})
+
+                    # The lexical index is built in the background after warm-up, searches rank semantically until then.
+                    while get_lexical_index() is not None and not get_lexical_index().seeded:
+                        await asyncio.sleep(0.1)
+
+                    await run_load("warmup", search, args.warmup, args.concurrency)
+                    results.append(await run_load(
+                        "search", lambda i: search(args.warmup + i), args.requests, args.concurrency))
+
+                if "suggest" in args.scenarios:
+                    picks = random.Random(args.seed)
+                    idents = [picks.choice(catalogue.packages)["FullIdent"] for _ in range(args.requests)]
+                    prefixes = [picks.choice(catalogue.packages)["Title"][:picks.randint(1, 8)]
+                                for _ in range(args.requests)]
+
+                    async def suggest(i: int) -> httpx.Response:
+                        if i % 2:
+                            return await client.get(f"/package/{idents[i]}/similar/")
+                        return await client.get("/package/autocomplete/", params={"q": prefixes[i]})
+
+                    # An index update builds the neighbour table in the background, keep that out of the timings.
+                    await client.post("/index/update/")
+                    while (await suggest(1)).status_code == 503:
+                        await asyncio.sleep(0.1)
+                    results.append(await run_load("suggest", suggest, args.requests, args.concurrency))
+
+                if "index_update" in args.scenarios:
+                    async def index_update(i: int) -> httpx.Response:
+                        catalogue.bump(args.update_size)
+                        return await client.post("/index/update/")
+
+                    results.append(await run_load("index_update", index_update, args.iterations, 1))
+
+                if "fetch_all" in args.scenarios:
+                    async def fetch_all(i: int) -> httpx.Response:
+                        return await client.get("/package/fetch/all/")
+
+                    results.append(await run_load("fetch_all", fetch_all, args.iterations, 1))
+
+        return results
+
+
+def print_report(results: list[dict]):
+    columns = ("scenario", "requests", "errors", "concurrency", "seconds", "throughput", "p50_ms", "p95_ms", "p99_ms")
+    print(" ".join(f"{column:>12}" for column in columns))
+    for result in results:
+        print(" ".join(f"{result[column]:>12}" for column in columns))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Load-test /search/, /package/*/similar/, /package/autocomplete/, /index/update/ and "
+                    "/package/fetch/all/ against seeded local fakes of OpenAI, "
+                    "Pinecone and Facepunch.")
+    parser.add_argument("--scenarios", default="search,suggest,index_update,fetch_all",
+                        help="Comma separated subset of search, suggest, index_update and fetch_all")
+    parser.add_argument("--catalogue", type=int, default=5000, help="Number of synthetic packages")
+    parser.add_argument("--requests", type=int, default=1000, help="Search requests to time")
+    parser.add_argument("--warmup", type=int, default=50, help="Search requests sent before timing starts")
+    parser.add_argument("--concurrency", type=int, default=32, help="Search requests kept in flight")
+    parser.add_argument("--queries", type=int, default=200, help="Distinct search phrases to draw requests from")
+    parser.add_argument("--search-mode", default="semantic", choices=("semantic", "hybrid", "lexical"))
+    parser.add_argument("--dimensions", type=int, help="Request shortened embeddings, e.g. 256 or 512")
+    parser.add_argument("--iterations", type=int, default=5, help="Runs of each index_update and fetch_all scenario")
+    parser.add_argument("--update-size", type=int, default=100, help="Packages bumped before each index update")
+    parser.add_argument("--openai-latency", type=float, default=80, help="Mean fake OpenAI latency in ms")
+    parser.add_argument("--pinecone-latency", type=float, default=40, help="Mean fake Pinecone latency in ms")
+    parser.add_argument("--facepunch-latency", type=float, default=60, help="Mean fake Facepunch latency in ms")
+    parser.add_argument("--jitter", type=float, default=0.25, help="Latency spread as a fraction of the mean")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="Also write the results to this file, e.g. to diff against a baseline")
+
+    args = parser.parse_args()
+    args.scenarios = {scenario.strip() for scenario in args.scenarios.split(",") if scenario.strip()}
+    results = asyncio.run(run_benchmarks(args))
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,2 @@
+from .fakes import (BackgroundServer, FakePineconeIndex, Latency, SyntheticCatalogue, create_facepunch_app,
+                    create_openai_app, seeded_embedding)
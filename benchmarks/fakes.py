@@ -0,0 +1,280 @@
+import asyncio
+import base64
+import hashlib
+import random
+import socket
+import threading
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from typing import Iterator, Optional
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI
+from pydantic import BaseModel
+
+from models import PineconeVector
+from services import LocalVectorService
+
+WORDS = (
+    "sandbox", "racing", "zombie", "survival", "physics", "puzzle", "shooter", "arena", "city", "forest",
+    "castle", "space", "station", "tools", "weapon", "vehicle", "car", "boat", "plane", "horror",
+    "party", "minigame", "parkour", "tycoon", "farm", "dungeon", "medieval", "cyberpunk", "retro", "pixel",
+    "map", "model", "material", "sound", "prop", "npc", "ai", "multiplayer", "coop", "roleplay",
+    "building", "destruction", "stealth", "platformer", "rhythm", "sports", "football", "golf", "fishing", "cooking"
+)
+TYPES = ("game", "map", "model", "material", "sound", "library", "addon")
+
+
+class Latency:
+    """ Seeded, jittered delay injected into every fake upstream call. """
+    mean_seconds: float
+    jitter: float
+
+    def __init__(self, mean_ms: float, jitter: float = 0.25, seed: int = 0):
+        self.mean_seconds = mean_ms / 1000
+        self.jitter = jitter
+        self.enabled = True
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample(self) -> float:
+        if not self.enabled or self.mean_seconds <= 0:
+            return 0.0
+        with self._lock:
+            factor = self._random.uniform(1 - self.jitter, 1 + self.jitter)
+        return self.mean_seconds * factor
+
+    def sleep(self):
+        delay = self.sample()
+        if delay:
+            time.sleep(delay)
+
+    async def asleep(self):
+        delay = self.sample()
+        if delay:
+            await asyncio.sleep(delay)
+
+
+def seeded_embedding(text: str, dimension: int = 1536, dimensions: Optional[int] = None) -> np.ndarray:
+    """ Unit vector derived only from the text, so every run embeds the same text identically.
+    With dimensions, it is shortened the way the real API shortens text-embedding-3 vectors. """
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dimension).astype(np.float32)
+    if dimensions:
+        vector = vector[:dimensions]
+    return vector / np.linalg.norm(vector)
+
+
+def _isoformat(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+class SyntheticCatalogue:
+    """ Deterministic package catalogue in the shape the Facepunch find API returns. """
+    packages: list[dict]
+
+    def __init__(self, size: int, seed: int = 0):
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        now = datetime(2026, 1, 1, tzinfo=timezone.utc).timestamp()
+        self._clock = now
+        self.packages = []
+        for i in range(size):
+            created = now - self._random.uniform(0, 365 * 24 * 3600)
+            updated = min(now, created + self._random.uniform(0, 90 * 24 * 3600))
+            self.packages.append(self._package(i, created, updated))
+
+    def _words(self, count: int) -> list[str]:
+        return [self._random.choice(WORDS) for _ in range(count)]
+
+    def _package(self, i: int, created: float, updated: float) -> dict:
+        org = f"org{i % 97}"
+        ident = f"{org}.{'_'.join(self._words(2))}_{i}"
+        return {
+            "Title": " ".join(word.capitalize() for word in self._words(self._random.randint(1, 3))),
+            "Summary": " ".join(self._words(self._random.randint(4, 16))),
+            "Tags": sorted(set(self._words(self._random.randint(0, 4)))),
+            "FullIdent": ident,
+            "TypeName": self._random.choice(TYPES),
+            "Thumb": f"https://cdn.example.invalid/{ident}.png",
+            "Created": _isoformat(created),
+            "Updated": _isoformat(updated)
+        }
+
+    def bump(self, count: int, text_change_ratio: float = 0.5) -> list[dict]:
+        """ Push new builds for count random packages, rewriting the summary of a share of them. """
+        with self._lock:
+            bumped = self._random.sample(self.packages, min(count, len(self.packages)))
+            for package in bumped:
+                self._clock += 1
+                package["Updated"] = _isoformat(self._clock)
+                if self._random.random() < text_change_ratio:
+                    package["Summary"] = " ".join(self._words(self._random.randint(4, 16)))
+            return bumped
+
+    def find(self, query: str, take: int, skip: int) -> list[dict]:
+        with self._lock:
+            if query == "sort:updated":
+                ordered = sorted(self.packages, key=lambda package: package["Updated"], reverse=True)
+            elif query == "sort:newest":
+                ordered = sorted(self.packages, key=lambda package: package["Created"], reverse=True)
+            else:
+                ordered = self.packages
+            return [dict(package) for package in ordered[skip:skip+take]]
+
+    def queries(self, count: int, seed: int = 0) -> list[str]:
+        """ A reproducible pool of search phrases drawn from the catalogue vocabulary. """
+        phrases = random.Random(seed)
+        return [" ".join(phrases.choice(WORDS) for _ in range(phrases.randint(1, 3))) for _ in range(count)]
+
+
+class FakePineconeIndex:
+    """ In-memory stand-in for the Pinecone data-plane Index: upsert, update, query, fetch, list and delete.
+
+    Scoring and filtering are delegated to a LocalVectorService, values are kept as float32 arrays.
+    """
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self._scorer = LocalVectorService()
+        self._vectors: dict[str, tuple[np.ndarray, dict]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._vectors)
+
+    def seed(self, vectors: list[PineconeVector]):
+        """ Load vectors without paying the injected latency. """
+        with self._lock:
+            for vector in vectors:
+                self._vectors[vector.id] = (np.asarray(vector.values, dtype=np.float32), dict(vector.metadata))
+        self._scorer.upsert_embeddings(vectors)
+
+    def upsert(self, vectors: list[dict]):
+        self.latency.sleep()
+        self.seed([PineconeVector(id=vector["id"], values=vector["values"], metadata=vector["metadata"])
+                   for vector in vectors])
+
+    def update(self, id: str, set_metadata: dict):
+        self.latency.sleep()
+        with self._lock:
+            if id not in self._vectors:
+                return
+            self._vectors[id][1].update(set_metadata)
+        self._scorer.update_metadata([PineconeVector(id=id, values=[], metadata=set_metadata)])
+
+    def query(self,
+              vector: list[float],
+              top_k: int,
+              include_values: bool = False,
+              include_metadata: bool = False,
+              filter: Optional[dict] = None) -> dict:
+        self.latency.sleep()
+        matches = self._scorer.search_pinecone(vector, top_k, 0, filter or {})
+        with self._lock:
+            return {"matches": [{
+                "id": match["id"],
+                "values": self._vectors[match["id"]][0].tolist() if include_values else [],
+                "metadata": match["metadata"] if include_metadata else {}
+            } for match in matches]}
+
+    def describe_index_stats(self) -> dict:
+        self.latency.sleep()
+        return {"dimension": self._scorer.dimension, "total_vector_count": len(self)}
+
+    def fetch(self, ids: list[str]) -> SimpleNamespace:
+        self.latency.sleep()
+        with self._lock:
+            return SimpleNamespace(vectors={
+                ident: SimpleNamespace(id=ident, values=self._vectors[ident][0].tolist(), metadata=dict(self._vectors[ident][1]))
+                for ident in ids if ident in self._vectors
+            })
+
+    def list(self, limit: int = 100) -> Iterator[list[str]]:
+        with self._lock:
+            ids = list(self._vectors)
+        for i in range(0, len(ids), limit):
+            self.latency.sleep()
+            yield ids[i:i+limit]
+
+    def delete(self, delete_all: bool = False):
+        self.latency.sleep()
+        if delete_all:
+            with self._lock:
+                self._vectors.clear()
+            self._scorer.delete_index()
+
+
+class _EmbeddingRequest(BaseModel):
+    input: list[str] | str
+    model: str
+    encoding_format: Optional[str] = None
+    dimensions: Optional[int] = None
+
+
+def create_openai_app(latency: Latency, dimension: int = 1536) -> FastAPI:
+    """ Embeddings endpoint returning seeded vectors, mounted under /v1 like the real API. """
+    app = FastAPI()
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: _EmbeddingRequest) -> dict:
+        await latency.asleep()
+        texts = [request.input] if isinstance(request.input, str) else request.input
+        vectors = [seeded_embedding(text, dimension, request.dimensions) for text in texts]
+        tokens = sum(len(text.split()) + 1 for text in texts)
+        return {
+            "object": "list",
+            "model": request.model,
+            "data": [{
+                "object": "embedding",
+                "index": i,
+                "embedding": base64.b64encode(vector.tobytes()).decode("ascii")
+                if request.encoding_format == "base64" else vector.tolist()
+            } for i, vector in enumerate(vectors)],
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens}
+        }
+
+    return app
+
+
+def create_facepunch_app(catalogue: SyntheticCatalogue, latency: Latency) -> FastAPI:
+    """ The package find endpoint the FacepunchService pages through. """
+    app = FastAPI()
+
+    @app.get("/sbox/package/find/1/")
+    async def find(q: str = "", take: int = 50, skip: int = 0) -> dict:
+        await latency.asleep()
+        packages = catalogue.find(q, take, skip)
+        return {"Packages": packages, "TotalCount": len(catalogue.packages)}
+
+    return app
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class BackgroundServer:
+    """ Runs an ASGI app under uvicorn on a daemon thread for the lifetime of a benchmark. """
+
+    def __init__(self, app, port: Optional[int] = None):
+        self.port = port or free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self._server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=self.port, log_level="warning"))
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+
+    def __enter__(self) -> "BackgroundServer":
+        self._thread.start()
+        while not self._server.started:
+            if not self._thread.is_alive():
+                raise RuntimeError(f"Server on port {self.port} failed to start")
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.should_exit = True
+        self._thread.join(timeout=5)
@@ -1,26 +1,171 @@
 from functools import lru_cache
 import os
-from services import PineconeService, OpenAiService, FacepunchService
+from typing import Optional
+from fastapi import Depends
+from services import PineconeService, LocalVectorService, OpenAiService, FacepunchService, EmbeddingCache, EmbeddingStore, LexicalIndex, NeighbourIndex, PackageCatalogue, RebuildTracker, SearchResultCache, SharedCache, TimestampIndex, IndexPipeline
+from utils import embedding_model_key
 from dotenv import load_dotenv
 
 load_dotenv()
 
+def get_embedding_dimensions() -> Optional[int]:
+    dimensions = os.getenv("EMBEDDING_DIMENSIONS")
+    return int(dimensions) if dimensions else None
+
+def get_embedding_model_key() -> str:
+    return embedding_model_key(os.getenv("EMBEDDING_MODEL"), get_embedding_dimensions())
+
 @lru_cache()
-def get_pinecone_service() -> PineconeService:
+def get_pinecone_service() -> PineconeService | LocalVectorService:
+    if os.getenv("VECTOR_BACKEND", "pinecone") == "local":
+        return LocalVectorService(
+            path=os.getenv("LOCAL_INDEX_PATH"),
+            embedding_model=get_embedding_model_key(),
+            quantization=os.getenv("LOCAL_INDEX_QUANTIZATION") or None,
+            rerank_factor=int(os.getenv("LOCAL_INDEX_RERANK_FACTOR", "4")),
+            prefix_dimensions=int(os.getenv("LOCAL_INDEX_PREFIX_DIMENSIONS", "0")) or None
+        )
+
     return PineconeService(
         api_key=os.getenv("PINECONE_KEY"),
-        index_name=os.getenv("PINECONE_INDEX")
+        index_name=os.getenv("PINECONE_INDEX"),
+        timestamp_index=TimestampIndex(path=os.getenv("TIMESTAMP_INDEX_PATH")),
+        max_concurrency=int(os.getenv("PINECONE_MAX_CONCURRENCY", "16")),
+        upsert_concurrency=int(os.getenv("PINECONE_UPSERT_CONCURRENCY", "8"))
+    )
+
+@lru_cache()
+def get_shared_cache() -> Optional[SharedCache]:
+    path = os.getenv("SHARED_CACHE_PATH")
+    if not path:
+        return None
+    return SharedCache(
+        path=path,
+        max_entries=int(os.getenv("SHARED_CACHE_SIZE", "100000")),
+        max_bytes=int(os.getenv("SHARED_CACHE_MB", "32")) * 1024 * 1024
+    )
+
+@lru_cache()
+def get_embedding_cache() -> EmbeddingCache:
+    return EmbeddingCache(
+        max_entries=int(os.getenv("EMBEDDING_CACHE_SIZE", "10000")),
+        ttl_seconds=float(os.getenv("EMBEDDING_CACHE_TTL", str(7 * 24 * 3600))),
+        path=os.getenv("EMBEDDING_CACHE_PATH"),
+        shared=get_shared_cache()
     )
 
+@lru_cache()
+def get_search_result_cache() -> SearchResultCache:
+    return SearchResultCache(
+        max_entries=int(os.getenv("SEARCH_CACHE_SIZE", "5000")),
+        ttl_seconds=float(os.getenv("SEARCH_CACHE_TTL", "3600")),
+        depth=int(os.getenv("SEARCH_CACHE_DEPTH", "100")),
+        shared=get_shared_cache()
+    )
+
+@lru_cache()
+def get_lexical_index() -> Optional[LexicalIndex]:
+    path = os.getenv("LEXICAL_INDEX_PATH")
+    if not path:
+        return None
+    return LexicalIndex(path=path)
+
+@lru_cache()
+def get_neighbour_index() -> Optional[NeighbourIndex]:
+    path = os.getenv("NEIGHBOUR_INDEX_PATH")
+    if not path:
+        return None
+    return NeighbourIndex(path=path, neighbours=int(os.getenv("NEIGHBOUR_COUNT", "20")))
+
+@lru_cache()
+def get_package_catalogue() -> PackageCatalogue:
+    return PackageCatalogue(path=os.getenv("PACKAGE_CATALOGUE_PATH") or ":memory:")
+
+@lru_cache()
+def get_embedding_store() -> Optional[EmbeddingStore]:
+    path = os.getenv("EMBEDDING_STORE_PATH")
+    if not path:
+        return None
+    return EmbeddingStore(path=path, embedding_model=get_embedding_model_key())
+
 @lru_cache()
 def get_openai_service() -> OpenAiService:
     return OpenAiService(
         api_key=os.getenv("OPENAI_KEY"),
-        embedding_model=os.getenv("EMBEDDING_MODEL")
+        embedding_model=os.getenv("EMBEDDING_MODEL"),
+        cache=get_embedding_cache(),
+        max_concurrency=int(os.getenv("OPENAI_MAX_CONCURRENCY", "16")),
+        batch_window_seconds=float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "2")) / 1000,
+        max_batch_size=int(os.getenv("EMBEDDING_BATCH_SIZE", "256")),
+        base_url=os.getenv("OPENAI_BASE_URL"),
+        dimensions=get_embedding_dimensions()
     )
 
 @lru_cache()
 def get_facepunch_service() -> FacepunchService:
     return FacepunchService(
-        base_url=os.getenv("FACEPUNCH_BASE_URL")
+        base_url=os.getenv("FACEPUNCH_BASE_URL"),
+        max_concurrency=int(os.getenv("FACEPUNCH_MAX_CONCURRENCY", "8"))
+    )
+
+@lru_cache()
+def get_rebuild_tracker() -> RebuildTracker:
+    return RebuildTracker(shared=get_shared_cache())
+
+# FastAPI runs sync dependencies in its threadpool, async ones resolve on the event loop.
+async def get_pinecone_service_async() -> PineconeService | LocalVectorService:
+    return get_pinecone_service()
+
+async def get_openai_service_async() -> OpenAiService:
+    return get_openai_service()
+
+async def get_search_result_cache_async() -> SearchResultCache:
+    return get_search_result_cache()
+
+async def get_lexical_index_async() -> Optional[LexicalIndex]:
+    return get_lexical_index()
+
+
+def _resolve(overrides: dict, provider):
+    return overrides.get(provider, provider)()
+
+def warm_up(overrides: dict = {}):
+    """ Build every service now rather than on first use, and open the vector index connection. """
+    def resolve(provider):
+        return _resolve(overrides, provider)
+
+    for provider in (get_shared_cache, get_embedding_cache, get_search_result_cache, get_lexical_index,
+                     get_neighbour_index, get_package_catalogue, get_embedding_store, get_openai_service,
+                     get_facepunch_service):
+        resolve(provider)
+    resolve(get_pinecone_service).warm_up()
+
+def reload_sidecars(overrides: dict = {}):
+    """ Load index sidecars that another worker has rewritten, so requests never wait on a reload. """
+    for provider in (get_lexical_index, get_neighbour_index):
+        index = _resolve(overrides, provider)
+        if index is not None:
+            index.reload_if_changed()
+
+def seed_lexical_index(overrides: dict = {}):
+    """ Build the lexical index from the vector index, unless it's disabled or its sidecar already provided it. """
+    lexical_index = _resolve(overrides, get_lexical_index)
+    if lexical_index is not None:
+        lexical_index.ensure_seeded(_resolve(overrides, get_pinecone_service).iter_vectors)
+
+
+def get_index_pipeline(
+    pinecone_service: PineconeService = Depends(get_pinecone_service),
+    openai_service: OpenAiService = Depends(get_openai_service)
+) -> IndexPipeline:
+    return IndexPipeline(
+        openai_service,
+        pinecone_service,
+        embed_concurrency=int(os.getenv("INDEX_EMBED_CONCURRENCY", "2")),
+        upsert_concurrency=int(os.getenv("INDEX_UPSERT_CONCURRENCY", "2")),
+        checkpoint_path=os.getenv("INDEX_CHECKPOINT_PATH"),
+        embedding_store=get_embedding_store(),
+        lexical_index=get_lexical_index(),
+        neighbour_index=get_neighbour_index(),
+        catalogue=get_package_catalogue()
     )
@@ -1,19 +1,70 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 import uvicorn
-from routes import package_routes, index_routes, search_routes
+from routes import package_routes, index_routes, search_routes, metrics_routes, health_routes
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
 from fastapi.middleware.httpsredirect import HTTPSRedirectMiddleware
 from fastapi.middleware.gzip import GZipMiddleware
+import dependencies
+from dependencies import get_embedding_cache, get_openai_service
+from metrics import ServerTimingMiddleware
 
-app = FastAPI()
+async def warm_up(app: FastAPI):
+    """ Build services and open upstream connections in the background, then report ready. """
+    start = time.perf_counter()
+    try:
+        await asyncio.to_thread(dependencies.warm_up, app.dependency_overrides)
+        app.dependency_overrides.get(get_openai_service, get_openai_service)().warm_up()
+    except Exception as e:
+        # Requests are still served, building whatever failed lazily, but the worker isn't reported ready.
+        app.state.warm_up_error = str(e) or type(e).__name__
+        print("Error warming up services.\nError:", e)
+        return
+    app.state.ready = True
+    print(f"Warmed up in {time.perf_counter() - start:.2f}s")
+
+    try:
+        await asyncio.to_thread(dependencies.seed_lexical_index, app.dependency_overrides)
+    except Exception as e:
+        print("Error seeding the lexical index.\nError:", e)
+
+async def reload_sidecars(app: FastAPI):
+    """ Poll for index sidecars rewritten by other workers once services are built. """
+    RELOAD_INTERVAL = 1.0
+    while True:
+        await asyncio.sleep(RELOAD_INTERVAL)
+        if not app.state.ready:
+            continue
+        try:
+            await asyncio.to_thread(dependencies.reload_sidecars, app.dependency_overrides)
+        except Exception as e:
+            print("Error reloading index sidecars.\nError:", e)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.ready = False
+    app.state.warm_up_error = None
+    warm_up_task = asyncio.create_task(warm_up(app))
+    reload_task = asyncio.create_task(reload_sidecars(app))
+    yield
+    warm_up_task.cancel()
+    reload_task.cancel()
+    get_embedding_cache().save()
+
+app = FastAPI(lifespan=lifespan)
 
 app.include_router(package_routes.router)
 app.include_router(index_routes.router)
 app.include_router(search_routes.router)
+app.include_router(metrics_routes.router)
+app.include_router(health_routes.router)
 
 app.add_middleware(TrustedHostMiddleware, allowed_hosts=["*"])
 # app.add_middleware(HTTPSRedirectMiddleware)
 app.add_middleware(GZipMiddleware)
+app.add_middleware(ServerTimingMiddleware)
 
 if __name__ == "__main__":
     print("Swagger UI available at http://localhost:8080/docs")
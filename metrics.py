@@ -0,0 +1,198 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterator, Optional
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(label_names: tuple[str, ...], label_values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """ Monotonic counter with optional labels, rendered in the Prometheus text format. """
+    name: str
+    documentation: str
+    label_names: tuple[str, ...]
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._values: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class Histogram:
+    """ Fixed-bucket histogram with optional labels, rendered in the Prometheus text format. """
+    name: str
+    documentation: str
+    label_names: tuple[str, ...]
+    buckets: tuple[float, ...]
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 label_names: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        # Per label set: a count per bucket with +Inf last, and the running sum in a one-item list.
+        self._values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            entry[0][index] += 1
+            entry[1][0] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    labels = _format_labels(self.label_names, key, f'le="{le}"')
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {total[0]}")
+                lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """ Process-wide set of metrics plus callbacks for values read at scrape time, such as cache stats. """
+
+    def __init__(self):
+        self._metrics: list[Counter | Histogram] = []
+        self._gauges: list[tuple[str, str, Callable[[], dict[tuple[str, ...], float]], tuple[str, ...]]] = []
+
+    def counter(self, name: str, documentation: str, label_names: tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, documentation, label_names)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, label_names: tuple[str, ...] = ()) -> Histogram:
+        metric = Histogram(name, documentation, label_names)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self,
+              name: str,
+              documentation: str,
+              collect: Callable[[], dict[tuple[str, ...], float]],
+              label_names: tuple[str, ...] = ()):
+        """ Register a gauge whose values are collected when the registry is rendered. """
+        self._gauges.append((name, documentation, collect, label_names))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for name, documentation, collect, label_names in self._gauges:
+            lines.extend([f"# HELP {name} {documentation}", f"# TYPE {name} gauge"])
+            for key, value in sorted(collect().items()):
+                lines.append(f"{name}{_format_labels(label_names, key)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "sbox_search_stage_seconds", "Time spent in each stage of handling a request.", ("stage",))
+UPSTREAM_SECONDS = REGISTRY.histogram(
+    "sbox_search_upstream_request_seconds", "Latency of each upstream call attempt.",
+    ("upstream", "operation"))
+UPSTREAM_RETRIES = REGISTRY.counter(
+    "sbox_search_upstream_retries_total", "Upstream calls retried after a failure.", ("upstream",))
+OPENAI_TOKENS = REGISTRY.counter(
+    "sbox_search_openai_tokens_total", "Tokens billed by the OpenAI embeddings API.")
+INDEXED_PACKAGES = REGISTRY.counter(
+    "sbox_search_indexed_packages_total", "Packages processed by the indexer.", ("operation",))
+
+_server_timing: ContextVar[Optional[dict[str, float]]] = ContextVar("server_timing", default=None)
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """ Record a request stage in the stage histogram and the current request's Server-Timing header. """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        timings = _server_timing.get()
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+
+def count_retry(upstream: str) -> Callable:
+    """ tenacity before_sleep hook counting retries against an upstream. """
+    def before_sleep(retry_state):
+        UPSTREAM_RETRIES.inc(upstream=upstream)
+    return before_sleep
+
+
+class ServerTimingMiddleware:
+    """ ASGI middleware adding a Server-Timing header with every stage timed while handling the request. """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings: dict[str, float] = {}
+        token = _server_timing.set(timings)
+        start = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                entries = [f"{stage};dur={elapsed * 1000:.1f}" for stage, elapsed in timings.items()]
+                entries.append(f"total;dur={(time.perf_counter() - start) * 1000:.1f}")
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", ", ".join(entries).encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _server_timing.reset(token)
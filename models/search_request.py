@@ -1,8 +1,15 @@
-from pydantic import BaseModel
+from typing import Literal
+from pydantic import BaseModel, Field
 
 
 class SearchRequest(BaseModel):
     query: str
     type_filter: list[str] = []
-    take: int = 5
-    skip: int = 0
\ No newline at end of file
+    # Pages are sliced out of a cached ranking, so negative values would silently select the wrong rows.
+    take: int = Field(5, gt=0)
+    skip: int = Field(0, ge=0)
+    # Metadata fields to return for each match, e.g. ["FullIdent", "Title", "Thumb"]. Empty returns them all.
+    fields: list[str] = []
+    # "hybrid" fuses BM25 and vector rankings, "lexical" skips embeddings entirely. Both answer ident-shaped
+    # queries like "facepunch.sandbox" straight from the lexical index.
+    mode: Literal["semantic", "hybrid", "lexical"] = "semantic"
\ No newline at end of file
@@ -0,0 +1,15 @@
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse
+
+router = APIRouter(prefix="/health")
+
+@router.get("/live/")
+def live() -> dict:
+    return {"status": "ok"}
+
+@router.get("/ready/")
+def ready(request: Request) -> JSONResponse:
+    """ 200 once this worker has finished warming up, 503 until then, e.g. for a load balancer probe. """
+    if request.app.state.ready:
+        return JSONResponse({"status": "ready"})
+    return JSONResponse({"status": "warming_up", "error": request.app.state.warm_up_error}, status_code=503)
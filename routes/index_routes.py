@@ -1,17 +1,30 @@
-from typing import List
-from fastapi import APIRouter, Depends
-from services import PineconeService, OpenAiService, FacepunchService
-from dependencies import get_pinecone_service, get_openai_service, get_facepunch_service
-from utils import from_timestamp, get_embed_string, get_pinecone_vector_from_package, to_timestamp
+import asyncio
+from contextlib import aclosing
+from typing import AsyncIterator, List, Optional
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException
+from services import PineconeService, OpenAiService, FacepunchService, IndexPipeline, EmbeddingStore, LexicalIndex, NeighbourIndex, RebuildTracker, SearchResultCache
+from dependencies import get_pinecone_service, get_openai_service, get_facepunch_service, get_index_pipeline, get_embedding_store, get_lexical_index, get_neighbour_index, get_rebuild_tracker, get_search_result_cache
+from utils import from_timestamp, to_timestamp
 from auth import verify_api_key
 
 router = APIRouter(prefix="/index")
 
 @router.post("/delete/", dependencies=[Depends(verify_api_key)])
 def delete(
-    pinecone_service: PineconeService = Depends(get_pinecone_service)
+    pinecone_service: PineconeService = Depends(get_pinecone_service),
+    embedding_store: Optional[EmbeddingStore] = Depends(get_embedding_store),
+    lexical_index: Optional[LexicalIndex] = Depends(get_lexical_index),
+    neighbour_index: Optional[NeighbourIndex] = Depends(get_neighbour_index),
+    result_cache: SearchResultCache = Depends(get_search_result_cache)
 ) -> dict:
     pinecone_service.delete_index()
+    if lexical_index is not None:
+        lexical_index.clear()
+    if neighbour_index is not None:
+        neighbour_index.clear()
+    if embedding_store is not None:
+        embedding_store.clear_indexed()
+    result_cache.invalidate()
     return {"message": "Index deleted"}
 
 @router.get("/fetch/recently-created/", dependencies=[Depends(verify_api_key)])
@@ -35,69 +48,135 @@ def fetch_recently_updated(
     } for result in results]
 
 @router.post("/update/", dependencies=[Depends(verify_api_key)])
-def index_update(
+async def index_update(
+    background_tasks: BackgroundTasks,
     facepunch_service: FacepunchService = Depends(get_facepunch_service),
     pinecone_service: PineconeService = Depends(get_pinecone_service),
-    openai_service: OpenAiService = Depends(get_openai_service)
+    openai_service: OpenAiService = Depends(get_openai_service),
+    index_pipeline: IndexPipeline = Depends(get_index_pipeline),
+    result_cache: SearchResultCache = Depends(get_search_result_cache)
 ) -> dict:
-    new_packages = fetch_newly_updated_packages(pinecone_service, facepunch_service)
-    new_packages += fetch_newly_created_packages(pinecone_service, facepunch_service)
+    new_packages = await fetch_new_packages(pinecone_service, facepunch_service)
 
     if not new_packages:
+        # Still catches the neighbour table up, which also seeds it the first time.
+        background_tasks.add_task(index_pipeline.refresh_neighbours)
         return {"message": "No new packages to index"}
 
-    embed_strings = [get_embed_string(package) for package in new_packages]
-    embeddings_list, tokens = openai_service.get_embeddings(embed_strings)
-    
-    vectors = [get_pinecone_vector_from_package(embeddings_list[i], package) 
-               for i, package in enumerate(new_packages)]
-
-    if vectors:
-        pinecone_service.upsert_embeddings(vectors)
-        return {
-            "message": f"Indexed {len(vectors)} packages with {tokens} tokens, cost ${openai_service.token_cost(tokens)}"
-        }
+    async def new_package_pages():
+        yield new_packages
+
+    progress = await index_pipeline.run(new_package_pages())
+    # Other workers only see this write through the shared cache generation.
+    result_cache.invalidate()
+    # Only reached when the run succeeded, a failed one leaves its vectors staged for the next refresh.
+    background_tasks.add_task(index_pipeline.refresh_neighbours)
+    return {
+        "message": f"Indexed {progress.upserted} packages with {progress.tokens} tokens, cost ${openai_service.token_cost(progress.tokens)}",
+        "metadata_updated": progress.metadata_updated,
+        "embeddings_saved": progress.embeddings_saved,
+        "tokens_saved": progress.tokens_saved,
+        "cost_saved": openai_service.token_cost(progress.tokens_saved)
+    }
+
+@router.post("/rebuild/", dependencies=[Depends(verify_api_key)])
+async def index_rebuild(
+    background_tasks: BackgroundTasks,
+    facepunch_service: FacepunchService = Depends(get_facepunch_service),
+    index_pipeline: IndexPipeline = Depends(get_index_pipeline),
+    rebuild_tracker: RebuildTracker = Depends(get_rebuild_tracker),
+    result_cache: SearchResultCache = Depends(get_search_result_cache)
+) -> dict:
+    if not await asyncio.to_thread(rebuild_tracker.claim):
+        raise HTTPException(status_code=409, detail="A rebuild is already running")
+
+    await asyncio.to_thread(rebuild_tracker.publish, index_pipeline.progress.to_dict())
+    background_tasks.add_task(run_rebuild, index_pipeline, facepunch_service.iter_package_pages(""), rebuild_tracker)
+    background_tasks.add_task(result_cache.invalidate)
+    # Background tasks stop at the first that raises, so a failed rebuild skips the refresh.
+    background_tasks.add_task(index_pipeline.refresh_neighbours)
+    return {"message": "Rebuild started"}
+
+@router.get("/rebuild/progress/", dependencies=[Depends(verify_api_key)])
+def index_rebuild_progress(rebuild_tracker: RebuildTracker = Depends(get_rebuild_tracker)) -> dict:
+    progress = rebuild_tracker.progress()
+    if progress is None:
+        raise HTTPException(status_code=404, detail="No rebuild has been started")
+    return progress
+
+
+async def run_rebuild(index_pipeline: IndexPipeline, pages: AsyncIterator[list[dict]], rebuild_tracker: RebuildTracker):
+    """ Run a full rebuild, publishing its progress every second so any worker can report it. """
+    PUBLISH_INTERVAL = 1.0
+
+    finished = asyncio.Event()
+
+    async def publish_progress():
+        while not finished.is_set():
+            await asyncio.to_thread(rebuild_tracker.publish, index_pipeline.progress.to_dict())
+            try:
+                await asyncio.wait_for(finished.wait(), PUBLISH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    publisher = asyncio.create_task(publish_progress())
+    try:
+        await index_pipeline.run(pages)
+    finally:
+        # Let an in-flight publish finish rather than cancelling it, or it could renew the lease after release.
+        finished.set()
+        await asyncio.gather(publisher, return_exceptions=True)
+        await asyncio.to_thread(rebuild_tracker.publish, index_pipeline.progress.to_dict())
+        await asyncio.to_thread(rebuild_tracker.release)
+
+
+async def fetch_new_packages(
+        pinecone_service: PineconeService,
+        facepunch_service: FacepunchService) -> list[dict]:
+    updated, created = await asyncio.gather(
+        fetch_newly_updated_packages(pinecone_service, facepunch_service),
+        fetch_newly_created_packages(pinecone_service, facepunch_service)
+    )
+    # A brand new package usually shows up in both listings, only embed it once.
+    return list({package['FullIdent']: package for package in updated + created}.values())
 
 
-def fetch_newly_updated_packages(
+async def fetch_newly_updated_packages(
         pinecone_service: PineconeService,
         facepunch_service: FacepunchService) -> list[dict]:
-    TAKE = 100
-    most_recent = pinecone_service.fetch_recently_updated_packages(1)[0]
-    most_recent_timestamp = most_recent.metadata['Updated']
-    facepunch_recent = facepunch_service.fetch_recently_updated_packages(TAKE, 0)
-
-    iteration = 0
-    while to_timestamp(facepunch_recent[-1]['Updated']) > most_recent_timestamp and iteration < 10:
-        iteration += 1
-        facepunch_recent = facepunch_service.fetch_recently_updated_packages(TAKE, TAKE*iteration)
+    most_recent = (await asyncio.to_thread(pinecone_service.fetch_recently_updated_packages, 1))[0]
+    return await fetch_packages_newer_than(
+        facepunch_service, "sort:updated", "Updated", most_recent.metadata['Updated'])
 
-    if iteration == 10:
-        return []
-    
-    packages_newer_than_most_recent = [x for x in facepunch_recent if to_timestamp(x['Updated']) > most_recent_timestamp]
-    packages_newer_than_most_recent.sort(key=lambda x: to_timestamp(x['Updated']), reverse=True)
 
-    return packages_newer_than_most_recent
+async def fetch_newly_created_packages(
+        pinecone_service: PineconeService,
+        facepunch_service: FacepunchService) -> list[dict]:
+    most_recent = (await asyncio.to_thread(pinecone_service.fetch_recently_created_packages, 1))[0]
+    return await fetch_packages_newer_than(
+        facepunch_service, "sort:newest", "Created", most_recent.metadata['Created'])
 
 
-def fetch_newly_created_packages(
-        pinecone_service: PineconeService, 
-        facepunch_service: FacepunchService) -> list[dict]:
+async def fetch_packages_newer_than(
+        facepunch_service: FacepunchService,
+        query: str,
+        field: str,
+        most_recent_timestamp: int) -> list[dict]:
+    """ Page through a sorted facepunch listing until we reach packages we've already indexed. """
     TAKE = 100
-    most_recent = pinecone_service.fetch_recently_created_packages(1)[0]
-    most_recent_timestamp = most_recent.metadata['Created']
-    facepunch_recent = facepunch_service.fetch_recently_created_packages(TAKE, 0)
-
-    iteration = 0
-    while to_timestamp(facepunch_recent[-1]['Created']) > most_recent_timestamp and iteration < 10:
-        iteration += 1
-        facepunch_recent = facepunch_service.fetch_recently_created_packages(TAKE, TAKE*iteration)
-
-    if iteration == 10:
-        return []
-    
-    packages_newer_than_most_recent = [x for x in facepunch_recent if to_timestamp(x['Created']) > most_recent_timestamp]
-    packages_newer_than_most_recent.sort(key=lambda x: to_timestamp(x['Created']), reverse=True)
+    MAX_PAGES = 10
+    packages = {}
+    pages = facepunch_service.iter_package_pages(query, TAKE, max_pages=MAX_PAGES, concurrency=2)
+    async with aclosing(pages):
+        async for page in pages:
+            for package in page:
+                packages[package['FullIdent']] = package
+            if len(page) < TAKE or to_timestamp(page[-1][field]) <= most_recent_timestamp:
+                break
+        else:
+            return []
+
+    packages_newer_than_most_recent = [x for x in packages.values() if to_timestamp(x[field]) > most_recent_timestamp]
+    packages_newer_than_most_recent.sort(key=lambda x: to_timestamp(x[field]), reverse=True)
 
     return packages_newer_than_most_recent
\ No newline at end of file
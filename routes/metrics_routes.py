@@ -0,0 +1,23 @@
+from fastapi import APIRouter, Depends
+from fastapi.responses import PlainTextResponse
+from dependencies import get_embedding_cache, get_search_result_cache
+from auth import verify_api_key
+from metrics import REGISTRY
+
+router = APIRouter()
+
+
+def _cache_stats() -> dict[str, dict]:
+    return {
+        "embedding": get_embedding_cache().stats(),
+        "results": get_search_result_cache().stats()
+    }
+
+REGISTRY.gauge("sbox_search_cache_hit_ratio", "Hit ratio of each in-process cache since startup.",
+               lambda: {(name,): stats["hit_ratio"] for name, stats in _cache_stats().items()}, ("cache",))
+REGISTRY.gauge("sbox_search_cache_entries", "Entries currently held by each in-process cache.",
+               lambda: {(name,): stats["size"] for name, stats in _cache_stats().items()}, ("cache",))
+
+@router.get("/metrics", dependencies=[Depends(verify_api_key)], response_class=PlainTextResponse)
+def metrics() -> str:
+    return REGISTRY.render()
@@ -1,29 +1,106 @@
-from fastapi import APIRouter, Depends
-from typing import List
-from services import FacepunchService
-from dependencies import get_facepunch_service
+import asyncio
+import httpx
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import JSONResponse, StreamingResponse
+from typing import List, Optional
+from services import FacepunchService, NeighbourIndex, PackageCatalogue
+from dependencies import get_facepunch_service, get_neighbour_index, get_package_catalogue
 from auth import verify_api_key
 
 router = APIRouter(prefix="/package")
 
+_seed_lock = asyncio.Lock()
+
 @router.get("/fetch/all/", dependencies=[Depends(verify_api_key)])
-def fetch_all(
-    facepunch_service: FacepunchService = Depends(get_facepunch_service)
+async def fetch_all(
+    take: Optional[int] = Query(None, gt=0),
+    skip: int = Query(0, ge=0),
+    facepunch_service: FacepunchService = Depends(get_facepunch_service),
+    catalogue: PackageCatalogue = Depends(get_package_catalogue)
 ) -> List[dict]:
-    return facepunch_service.fetch_all_packages()
+    await ensure_catalogue_seeded(catalogue, facepunch_service)
+    if take is not None:
+        return await asyncio.to_thread(catalogue.page, "ident", take, skip)
+    return StreamingResponse(catalogue.iter_json(), media_type="application/json")
 
 @router.get("/fetch/recently-created/", dependencies=[Depends(verify_api_key)])
 def fetch_recently_created(
     take: int,
     skip: int,
-    facepunch_service: FacepunchService = Depends(get_facepunch_service)
+    facepunch_service: FacepunchService = Depends(get_facepunch_service),
+    catalogue: PackageCatalogue = Depends(get_package_catalogue)
 ) -> List[dict]:
-    return facepunch_service.fetch_recently_created_packages(take, skip)
+    if not catalogue.is_seeded():
+        return facepunch_service.fetch_recently_created_packages(take, skip)
+    return catalogue.page("created", take, skip)
 
 @router.get("/fetch/recently-updated/", dependencies=[Depends(verify_api_key)])
 def fetch_recently_updated_facepunch(
     take: int,
     skip: int,
-    facepunch_service: FacepunchService = Depends(get_facepunch_service)
+    facepunch_service: FacepunchService = Depends(get_facepunch_service),
+    catalogue: PackageCatalogue = Depends(get_package_catalogue)
 ) -> List[dict]:
-    return facepunch_service.fetch_recently_updated_packages(take, skip)
\ No newline at end of file
+    if not catalogue.is_seeded():
+        return facepunch_service.fetch_recently_updated_packages(take, skip)
+    return catalogue.page("updated", take, skip)
+
+@router.get("/autocomplete/", dependencies=[Depends(verify_api_key)])
+def autocomplete(
+    q: str,
+    take: int = Query(8, gt=0),
+    fields: List[str] = Query([]),
+    neighbour_index: Optional[NeighbourIndex] = Depends(get_neighbour_index)
+) -> dict:
+    """ Title completions for a typed prefix and the packages nearest to them, without an embedding call. """
+    require_neighbours(neighbour_index)
+    suggestions = neighbour_index.autocomplete(q, take)
+    return JSONResponse({group: select_fields(results, fields) for group, results in suggestions.items()})
+
+@router.get("/{ident}/similar/", dependencies=[Depends(verify_api_key)])
+def similar(
+    ident: str,
+    take: int = Query(10, gt=0),
+    fields: List[str] = Query([]),
+    neighbour_index: Optional[NeighbourIndex] = Depends(get_neighbour_index)
+) -> List[dict]:
+    """ The packages nearest to ident, read from the precomputed neighbour table. """
+    require_neighbours(neighbour_index)
+    results = neighbour_index.similar(ident, take)
+    if results is None:
+        raise HTTPException(status_code=404, detail=f"Package {ident} is not indexed")
+    return JSONResponse(select_fields(results, fields))
+
+
+def select_fields(results: list[dict], fields: list[str]) -> list[dict]:
+    if not fields:
+        return results
+    return [{**result, "metadata": {field: result["metadata"][field] for field in fields if field in result["metadata"]}}
+            for result in results]
+
+
+def require_neighbours(neighbour_index: Optional[NeighbourIndex]):
+    """ The table is opt-in and built by the indexer in the background, never inside a request. """
+    if neighbour_index is None:
+        raise HTTPException(status_code=404, detail="Similar packages are disabled, set NEIGHBOUR_INDEX_PATH to enable them")
+    if len(neighbour_index) == 0:
+        raise HTTPException(status_code=503, detail="The neighbour table is built after the next index update")
+
+
+async def ensure_catalogue_seeded(catalogue: PackageCatalogue, facepunch_service: FacepunchService):
+    """ Crawl Facepunch into the catalogue the first time it's needed, after that the indexer keeps it in sync. """
+    if await asyncio.to_thread(catalogue.is_seeded):
+        return
+    async with _seed_lock:
+        if await asyncio.to_thread(catalogue.is_seeded):
+            return
+        # Only a complete crawl is mirrored, a failed page leaves the catalogue unseeded for the next request to retry.
+        packages = []
+        try:
+            async for page in facepunch_service.iter_package_pages(""):
+                packages.extend(page)
+        except httpx.HTTPError as e:
+            print("Error fetching data from facepunch backend.\nError:", e)
+            raise HTTPException(status_code=502, detail="Could not fetch the package catalogue from Facepunch")
+        await asyncio.to_thread(catalogue.seed, packages)
+        print(f"Mirrored {len(packages)} packages into the local catalogue")
@@ -1,29 +1,183 @@
-from typing import List
-from fastapi import APIRouter, Depends
-from services import PineconeService, OpenAiService
-from dependencies import get_pinecone_service, get_openai_service
+import asyncio
+from typing import List, Optional
+from fastapi import APIRouter, Depends, HTTPException
+from pydantic import ValidationError
+from fastapi.responses import JSONResponse
+from services import PineconeService, OpenAiService, EmbeddingCache, SearchResultCache, LexicalIndex
+from dependencies import get_pinecone_service_async, get_openai_service_async, get_embedding_cache, get_search_result_cache, get_search_result_cache_async, get_lexical_index_async
 from models import SearchRequest
+from auth import verify_api_key
+from metrics import timed
+from utils import reciprocal_rank_fusion
 
 router = APIRouter(prefix="/search")
 
+MAX_BATCH_SIZE = 32
+
 @router.post("/")
-def search(
+async def search(
     request: SearchRequest,
-    pinecone_service: PineconeService = Depends(get_pinecone_service),
-    openai_service: OpenAiService = Depends(get_openai_service)
+    pinecone_service: PineconeService = Depends(get_pinecone_service_async),
+    openai_service: OpenAiService = Depends(get_openai_service_async),
+    result_cache: SearchResultCache = Depends(get_search_result_cache_async),
+    lexical_index: Optional[LexicalIndex] = Depends(get_lexical_index_async)
+) -> List[dict]:
+    results = await search_one(request, pinecone_service, openai_service, result_cache, lexical_index)
+    with timed("encode"):
+        return JSONResponse(results)
+
+@router.post("/batch/")
+async def search_batch(
+    items: List[dict],
+    pinecone_service: PineconeService = Depends(get_pinecone_service_async),
+    openai_service: OpenAiService = Depends(get_openai_service_async),
+    result_cache: SearchResultCache = Depends(get_search_result_cache_async),
+    lexical_index: Optional[LexicalIndex] = Depends(get_lexical_index_async)
 ) -> List[dict]:
+    """ Run several searches in one round trip, returning {"results"} or {"error"} for each in order. """
+    if len(items) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_SIZE} searches per batch")
+
+    # Items are validated one by one, so an invalid item is reported in its slot instead of failing the batch.
+    requests: list[SearchRequest | ValueError] = [parse_search_request(item) for item in items]
+    searches = {i: request for i, request in enumerate(requests) if isinstance(request, SearchRequest)}
+
+    # Rankings that are already cached need no embedding, and are handed straight to their search.
+    lookups = [i for i, request in searches.items() if uses_semantic_ranking(request, lexical_index)]
+    cached = dict(zip(lookups, await asyncio.gather(*[
+        cached_ranking(searches[i], pinecone_service, openai_service, result_cache) for i in lookups])))
+
+    # One embeddings call for every distinct query that still needs a vector search.
+    queries = list(dict.fromkeys(searches[i].query for i, ranking in cached.items() if ranking is None))
+    embeddings = {}
+    if queries:
+        try:
+            with timed("embed"):
+                query_embeddings, _ = await openai_service.get_query_embeddings_async(queries)
+            embeddings = dict(zip(queries, query_embeddings))
+        except Exception as e:
+            # Let each search fail or fall back on its own rather than failing the whole batch here.
+            print("Error embedding batch search queries.\nError:", e)
+
+    async def run(i: int) -> list[dict]:
+        if i not in searches:
+            raise requests[i]
+        request = searches[i]
+        return await search_one(request, pinecone_service, openai_service, result_cache, lexical_index,
+                                embeddings.get(request.query), cached.get(i), lookup=i not in cached)
+
+    outcomes = await asyncio.gather(*[run(i) for i in range(len(requests))], return_exceptions=True)
+
+    with timed("encode"):
+        return JSONResponse([{"error": str(outcome) or type(outcome).__name__} if isinstance(outcome, Exception)
+                             else {"results": outcome} for outcome in outcomes])
+
+
+def parse_search_request(item: dict) -> SearchRequest | ValueError:
+    try:
+        return SearchRequest.model_validate(item)
+    except ValidationError as e:
+        return ValueError("; ".join(f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}"
+                                    for error in e.errors()))
+
+
+def uses_semantic_ranking(request: SearchRequest, lexical_index: Optional[LexicalIndex]) -> bool:
+    # The lexical index is opt-in and built in the background after warm-up, without it every mode ranks semantically.
+    return request.mode != "lexical" or lexical_index is None or not lexical_index.seeded
+
+
+async def search_one(
+        request: SearchRequest,
+        pinecone_service: PineconeService,
+        openai_service: OpenAiService,
+        result_cache: SearchResultCache,
+        lexical_index: Optional[LexicalIndex],
+        query_embedding: Optional[list[float]] = None,
+        cached: Optional[list[dict]] = None,
+        lookup: bool = True) -> list[dict]:
+    depth = max(result_cache.depth, request.take + request.skip)
+
+    if request.mode == "semantic" or lexical_index is None or not lexical_index.seeded:
+        ranked = await semantic_ranking(request, pinecone_service, openai_service, result_cache, query_embedding, cached, lookup)
+    else:
+        # Ident lookups are answered without an embedding at all.
+        ident_matches = await asyncio.to_thread(lexical_index.ident_matches, request.query, depth, request.type_filter)
+        if ident_matches:
+            ranked = ident_matches
+        elif request.mode == "lexical":
+            ranked = await lexical_ranking(request, lexical_index, depth)
+        else:
+            semantic, lexical = await asyncio.gather(
+                semantic_ranking(request, pinecone_service, openai_service, result_cache, query_embedding, cached, lookup),
+                lexical_ranking(request, lexical_index, depth)
+            )
+            with timed("shape"):
+                ranked = reciprocal_rank_fusion([semantic, lexical])
+
+    with timed("shape"):
+        results = ranked[request.skip:request.skip+request.take]
+        if request.fields:
+            results = [{
+                "id": result["id"],
+                "metadata": {field: result["metadata"][field] for field in request.fields if field in result["metadata"]},
+            } for result in results]
+
+    return results
+
+
+async def lexical_ranking(request: SearchRequest, lexical_index: LexicalIndex, depth: int) -> list[dict]:
+    with timed("lexical"):
+        return await asyncio.to_thread(lexical_index.search, request.query, depth, request.type_filter)
+
+
+async def cached_ranking(
+        request: SearchRequest,
+        pinecone_service: PineconeService,
+        openai_service: OpenAiService,
+        result_cache: SearchResultCache) -> Optional[list[dict]]:
+    top_k = max(result_cache.depth, request.take + request.skip)
+    return await result_cache.get_async(request.query, openai_service.model_key, request.type_filter,
+                                        pinecone_service.index_version, top_k, 0)
+
+
+async def semantic_ranking(
+        request: SearchRequest,
+        pinecone_service: PineconeService,
+        openai_service: OpenAiService,
+        result_cache: SearchResultCache,
+        query_embedding: Optional[list[float]] = None,
+        cached: Optional[list[dict]] = None,
+        lookup: bool = True) -> list[dict]:
+    """ The whole ranked window of vector search results covering the requested page, cached per query.
+    Callers that have already looked the ranking up pass what they found as cached with lookup=False. """
+    index_version = pinecone_service.index_version
+    top_k = max(result_cache.depth, request.take + request.skip)
+    ranked = await cached_ranking(request, pinecone_service, openai_service, result_cache) if lookup else cached
+    if ranked is not None:
+        return ranked
+
     filter_dict = {}
     if len(request.type_filter) > 0:
         filter_dict = {"Type": {"$in": request.type_filter}}
 
-    query_embedding, _ = openai_service.get_embedding(request.query)
-    results = pinecone_service.search_pinecone(
-        query_embedding, request.take, request.skip, filter_dict
-    )
-    if len(results) == 0:
-        return []
-    
-    return [{
-        "id": result.id,
-        "metadata": result.metadata,
-    } for result in results]
\ No newline at end of file
+    # Rank a whole window once so later pages of the same query are served by slicing it.
+    if query_embedding is None:
+        with timed("embed"):
+            query_embedding, _ = await openai_service.get_embedding_async(request.query)
+    with timed("vector_query"):
+        ranked = await pinecone_service.search_pinecone_async(query_embedding, top_k, 0, filter_dict)
+    await result_cache.set_async(request.query, openai_service.model_key, request.type_filter,
+                                 index_version, ranked, top_k)
+    return ranked
+
+@router.get("/cache/stats/", dependencies=[Depends(verify_api_key)])
+def cache_stats(
+    embedding_cache: EmbeddingCache = Depends(get_embedding_cache)
+) -> dict:
+    return embedding_cache.stats()
+
+@router.get("/cache/results/stats/", dependencies=[Depends(verify_api_key)])
+def result_cache_stats(
+    result_cache: SearchResultCache = Depends(get_search_result_cache)
+) -> dict:
+    return result_cache.stats()
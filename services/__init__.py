@@ -1,3 +1,17 @@
+from .embedding_batcher import EmbeddingBatcher
+from .embedding_cache import EmbeddingCache
+from .embedding_store import EmbeddingStore
 from .facepunch_service import FacepunchService
+from .index_pipeline import IndexPipeline, IndexProgress
+from .lexical_index import LexicalIndex
+from .local_vector_service import LocalVectorService
+from .neighbour_index import NeighbourIndex
 from .open_ai_service import OpenAiService
+from .package_catalogue import PackageCatalogue
 from .pinecone_service import PineconeService
+from .quantization import Int8Quantizer, ProductQuantizer
+from .rebuild_tracker import RebuildTracker
+from .search_result_cache import SearchResultCache
+from .shared_cache import SharedCache
+from .timestamp_index import TimestampIndex
+from .vector_snapshot import SnapshotWriter, VectorSnapshot
@@ -0,0 +1,75 @@
+import asyncio
+from typing import Awaitable, Callable, Optional
+
+from utils import apportion_tokens
+
+
+class EmbeddingBatcher:
+    """ Coalesces embedding requests arriving within a short window into a single API call.
+
+    Identical texts in the same window share one input and one result. When split_on_error says a failed batch's
+    error is down to its input, each text is re-sent on its own so one bad query can't fail the others.
+    Must be used from a single event loop.
+    """
+    window_seconds: float
+    max_batch_size: int
+
+    def __init__(self,
+                 embed: Callable[[list[str]], Awaitable[tuple[list[list[float]], int]]],
+                 window_seconds: float = 0.002,
+                 max_batch_size: int = 256,
+                 split_on_error: Optional[Callable[[Exception], bool]] = None):
+        if not 0 < max_batch_size <= 2048:
+            raise ValueError("max_batch_size must be between 1 and 2048")
+        self._embed = embed
+        self._split_on_error = split_on_error
+        self.window_seconds = window_seconds
+        self.max_batch_size = max_batch_size
+        self._pending: dict[str, asyncio.Future] = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._in_flight: set[asyncio.Task] = set()
+
+    async def embed(self, text: str) -> tuple[list[float], int]:
+        """ Embedding and this text's share of the batch's tokens. """
+        future = self._pending.get(text)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._pending[text] = future
+            if len(self._pending) >= self.max_batch_size:
+                self._flush()
+            elif self._flush_handle is None:
+                self._flush_handle = loop.call_later(self.window_seconds, self._flush)
+
+        # One caller giving up must not cancel the result everyone else in the batch is waiting on.
+        return await asyncio.shield(future)
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+
+        batch, self._pending = self._pending, {}
+        task = asyncio.get_running_loop().create_task(self._send(batch))
+        self._in_flight.add(task)
+        task.add_done_callback(self._in_flight.discard)
+
+    async def _send(self, batch: dict[str, asyncio.Future]):
+        texts = list(batch)
+        try:
+            embeddings, tokens = await self._embed(texts)
+        except Exception as e:
+            if len(texts) > 1 and self._split_on_error is not None and self._split_on_error(e):
+                await asyncio.gather(*[self._send({text: future}) for text, future in batch.items()])
+                return
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for text, embedding, text_tokens in zip(texts, embeddings, apportion_tokens(texts, tokens)):
+            future = batch[text]
+            if not future.done():
+                future.set_result((embedding, text_tokens))
@@ -0,0 +1,139 @@
+import asyncio
+import pickle
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Optional
+
+from utils import normalize_query
+from .shared_cache import SharedCache
+from .sidecar import Sidecar
+
+
+class EmbeddingCache:
+    """ Bounded LRU + TTL cache of query embeddings, optionally persisted to disk and backed by a cache
+    shared with the other worker processes. """
+    max_entries: int
+    ttl_seconds: float
+    path: Optional[str]
+    shared: Optional[SharedCache]
+
+    def __init__(self,
+                 max_entries: int = 10_000,
+                 ttl_seconds: float = 7 * 24 * 3600,
+                 path: Optional[str] = None,
+                 shared: Optional[SharedCache] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.path = path
+        self.shared = shared
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[float, array]] = OrderedDict()
+        self._lock = threading.Lock()
+
+        if path:
+            self.load()
+
+    @staticmethod
+    def make_key(text: str, model: str) -> str:
+        return f"{model}\x00{normalize_query(text)}"
+
+    def get(self, text: str, model: str) -> Optional[list[float]]:
+        """ Return the cached embedding for a query, or None on a miss. """
+        key = self.make_key(text, model)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] >= time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1].tolist()
+            if entry is not None:
+                del self._entries[key]
+
+        value = self.shared.get(f"embedding\x00{key}") if self.shared is not None else None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            # Another worker embedded this query; keep a local copy for the rest of our TTL.
+            embedding = array("f", value)
+            self._store(key, embedding)
+            self.shared_hits += 1
+            return embedding.tolist()
+
+    async def get_async(self, text: str, model: str) -> Optional[list[float]]:
+        """ get, in a worker thread when a lookup may wait on the shared cache's file lock. """
+        if self.shared is None:
+            return self.get(text, model)
+        return await asyncio.to_thread(self.get, text, model)
+
+    async def set_async(self, text: str, model: str, embedding: list[float]):
+        if self.shared is None:
+            return self.set(text, model, embedding)
+        await asyncio.to_thread(self.set, text, model, embedding)
+
+    def set(self, text: str, model: str, embedding: list[float]):
+        """ Store an embedding, evicting the least recently used entries when full. """
+        key = self.make_key(text, model)
+        values = array("f", embedding)
+        with self._lock:
+            self._store(key, values)
+        if self.shared is not None:
+            self.shared.set(f"embedding\x00{key}", values.tobytes(), self.ttl_seconds)
+
+    def _store(self, key: str, embedding: array):
+        self._entries[key] = (time.time() + self.ttl_seconds, embedding)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.shared_hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "hit_ratio": (self.hits + self.shared_hits) / lookups if lookups else 0.0
+            }
+
+    def load(self):
+        """ Load persisted entries, dropping any that have expired. """
+        try:
+            with open(self.path, "rb") as f:
+                entries = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError) as e:
+            if not isinstance(e, FileNotFoundError):
+                print("Error loading embedding cache.\nError:", e)
+            return
+
+        now = time.time()
+        with self._lock:
+            for key, (expires_at, embedding) in entries:
+                if expires_at >= now:
+                    self._entries[key] = (expires_at, embedding)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def save(self):
+        """ Atomically persist the cache in LRU order. """
+        if not self.path:
+            return
+
+        with self._lock:
+            entries = list(self._entries.items())
+
+        Sidecar(self.path).write(lambda f: pickle.dump(entries, f, protocol=pickle.HIGHEST_PROTOCOL))
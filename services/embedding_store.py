@@ -0,0 +1,69 @@
+import hashlib
+import sqlite3
+import threading
+from array import array
+
+
+class EmbeddingStore:
+    """ Content-addressed embeddings keyed by a hash of the embed string and model, backed by SQLite.
+
+    Also records which content hash is currently indexed for each package, so the indexer can tell
+    a metadata-only change from one that needs a new vector.
+    """
+    path: str
+    embedding_model: str
+
+    def __init__(self, path: str, embedding_model: str):
+        self.path = path
+        self.embedding_model = embedding_model
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (hash TEXT PRIMARY KEY, tokens INTEGER NOT NULL, vector BLOB NOT NULL)")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS indexed (ident TEXT PRIMARY KEY, hash TEXT NOT NULL)")
+
+    def content_hash(self, text: str) -> str:
+        return hashlib.sha256(f"{self.embedding_model}\x00{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, hashes: list[str]) -> dict[str, tuple[list[float], int]]:
+        """ Stored (embedding, tokens) for whichever hashes are present. """
+        found = {}
+        with self._lock:
+            for i in range(0, len(hashes), 500):
+                chunk = hashes[i:i+500]
+                rows = self._connection.execute(
+                    f"SELECT hash, tokens, vector FROM embeddings WHERE hash IN ({','.join('?' * len(chunk))})", chunk)
+                for content_hash, tokens, vector in rows:
+                    found[content_hash] = (array("f", vector).tolist(), tokens)
+        return found
+
+    def put_many(self, entries: list[tuple[str, list[float], int]]):
+        """ Store (hash, embedding, tokens) entries. """
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (hash, tokens, vector) VALUES (?, ?, ?)",
+                [(content_hash, tokens, array("f", embedding).tobytes()) for content_hash, embedding, tokens in entries])
+
+    def indexed_hashes(self, idents: list[str]) -> dict[str, str]:
+        """ Content hash currently indexed for each of idents, where known. """
+        found = {}
+        with self._lock:
+            for i in range(0, len(idents), 500):
+                chunk = idents[i:i+500]
+                rows = self._connection.execute(
+                    f"SELECT ident, hash FROM indexed WHERE ident IN ({','.join('?' * len(chunk))})", chunk)
+                found.update(rows)
+        return found
+
+    def mark_indexed(self, pairs: list[tuple[str, str]]):
+        """ Record (ident, hash) pairs once their vectors have been upserted. """
+        with self._lock, self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO indexed (ident, hash) VALUES (?, ?)", pairs)
+
+    def clear_indexed(self):
+        """ Forget what is indexed, e.g. after the index has been deleted. Stored embeddings are kept. """
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM indexed")
@@ -1,54 +1,155 @@
+import asyncio
+import time
+from typing import AsyncIterator, Optional
+import httpx
 import requests
-from tenacity import retry, stop_after_attempt, wait_exponential
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+
+from metrics import UPSTREAM_SECONDS, count_retry
+
+
+def _is_transient(exception: BaseException) -> bool:
+    if isinstance(exception, httpx.HTTPStatusError):
+        return exception.response.status_code == 429 or exception.response.status_code >= 500
+    return isinstance(exception, httpx.TransportError)
+
+
+def _wait_for_rate_limit(retry_state) -> float:
+    """ Honour Retry-After on 429s, otherwise back off exponentially. """
+    exception = retry_state.outcome.exception()
+    backoff = wait_exponential(multiplier=1, min=1, max=10)(retry_state)
+    if not (isinstance(exception, httpx.HTTPStatusError) and exception.response.status_code == 429):
+        return backoff
+
+    try:
+        retry_after = float(exception.response.headers.get("Retry-After", backoff))
+    except ValueError:
+        retry_after = backoff
+    # Every in-flight request shares the pause, not just the one that was throttled.
+    service = retry_state.args[0]
+    service._rate_limited_until = max(service._rate_limited_until, time.monotonic() + retry_after)
+    return retry_after
 
 
 class FacepunchService:
     base_url: str
+    max_concurrency: int
+    PAGE_SIZE = 500
 
-    def __init__(self, base_url: str):
+    def __init__(self, base_url: str, max_concurrency: int = 8):
         self.base_url = base_url
+        self.max_concurrency = max_concurrency
+        self._client: Optional[httpx.AsyncClient] = None
+        self._client_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._rate_limited_until = 0.0
 
     def fetch_recently_updated_packages(self, take: int, skip: int) -> list[dict]:
         return self._inner_fetch_package("sort:updated", take, skip)
-    
+
     def fetch_recently_created_packages(self, take: int, skip: int) -> list[dict]:
         return self._inner_fetch_package("sort:newest", take, skip)
 
     def fetch_all_packages(self) -> list[dict]:
+        return asyncio.run(self.fetch_all_packages_async())
+
+    async def fetch_all_packages_async(self) -> list[dict]:
         packages = []
         try:
-            skip = 0
-            while True:
-                current_packages = self._inner_fetch_package("", 500, skip)
-                packages.extend(current_packages)
-                
-                if len(current_packages) < 500:
-                    break
+            async for page in self.iter_package_pages(""):
+                packages.extend(page)
 
-                skip += 500
-            
             return packages
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             print("Error fetching data from facepunch backend.\nError:", e)
             return []
-    
-    @retry(stop=stop_after_attempt(4), wait=wait_exponential(multiplier=1, min=1, max=10))
+
+    async def iter_package_pages(self,
+                                 query: str,
+                                 take: int = PAGE_SIZE,
+                                 skip: int = 0,
+                                 max_pages: Optional[int] = None,
+                                 concurrency: Optional[int] = None) -> AsyncIterator[list[dict]]:
+        """ Stream pages in order, keeping up to concurrency requests in flight ahead of the consumer. """
+        window = min(concurrency or self.max_concurrency, self.max_concurrency)
+        pending: list[asyncio.Task] = []
+        next_skip = skip
+        scheduled = 0
+
+        def schedule():
+            nonlocal next_skip, scheduled
+            while len(pending) < window and (max_pages is None or scheduled < max_pages):
+                pending.append(asyncio.create_task(self._inner_fetch_package_async(query, take, next_skip)))
+                next_skip += take
+                scheduled += 1
+
+        try:
+            schedule()
+            while pending:
+                page = await pending.pop(0)
+                yield page
+                # A short page is the end of the catalogue, anything still in flight is past it.
+                if len(page) < take:
+                    break
+                schedule()
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """ Pooled keep-alive client, recreated if we're called from a different event loop. """
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client_loop is not loop:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=httpx.Timeout(30.0, connect=10.0),
+                limits=httpx.Limits(max_connections=self.max_concurrency,
+                                    max_keepalive_connections=self.max_concurrency)
+            )
+            self._client_loop = loop
+        return self._client
+
+    @retry(stop=stop_after_attempt(6), wait=_wait_for_rate_limit, retry=retry_if_exception(_is_transient), reraise=True,
+           before_sleep=count_retry("facepunch"))
+    async def _inner_fetch_package_async(self, query: str, take: int, skip: int) -> list[dict]:
+        """ Fetch packages from facepunch backend over the pooled async client. """
+        if take > 500:
+            raise ValueError("Take must be less than or equal to 500")
+
+        delay = self._rate_limited_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        query_params = {
+            "skip": skip,
+            "take": take,
+            "q": query
+        }
+        with UPSTREAM_SECONDS.time(upstream="facepunch", operation="find"):
+            response = await self._get_client().get("/sbox/package/find/1/", params=query_params)
+        response.raise_for_status()
+        json_data = response.json()
+
+        return json_data['Packages']
+
+    @retry(stop=stop_after_attempt(4), wait=wait_exponential(multiplier=1, min=1, max=10), before_sleep=count_retry("facepunch"))
     def _inner_fetch_package(self, query: str, take: int, skip: int) -> list[dict]:
         """ Fetch packages from facepunch backend. """
         if take > 500:
             raise ValueError("Take must be less than or equal to 500")
-        
+
         query_params = {
-            "skip": skip, 
+            "skip": skip,
             "take": take,
             "q": query
         }
-        response = requests.get(f"{self.base_url}/sbox/package/find/1/", params=query_params)
+        with UPSTREAM_SECONDS.time(upstream="facepunch", operation="find"):
+            response = requests.get(f"{self.base_url}/sbox/package/find/1/", params=query_params)
         response.raise_for_status()
         json_data = response.json()
 
         return json_data['Packages']
-        
+
     def fetch_all_packages_from_file(self, filename: str) -> list[dict]:
         try:
             with open(filename, 'r') as f:
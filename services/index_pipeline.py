@@ -0,0 +1,285 @@
+import asyncio
+import json
+import os
+import time
+from typing import AsyncIterator, Optional
+
+from metrics import INDEXED_PACKAGES, timed
+from models import PineconeVector
+from utils import apportion_tokens, get_embed_string, get_pinecone_vector_from_package, to_timestamp
+from .embedding_store import EmbeddingStore
+from .lexical_index import LexicalIndex
+from .neighbour_index import NeighbourIndex
+from .package_catalogue import PackageCatalogue
+from .open_ai_service import OpenAiService
+from .pinecone_service import PineconeService
+
+
+class IndexProgress:
+    """ Running counters for an indexing job. """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.fetched = 0
+        self.skipped = 0
+        self.embedded = 0
+        self.upserted = 0
+        self.metadata_updated = 0
+        self.tokens = 0
+        self.embeddings_saved = 0
+        self.tokens_saved = 0
+        self.error: Optional[str] = None
+
+    @property
+    def running(self) -> bool:
+        return self.finished_at is None
+
+    def to_dict(self) -> dict:
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        return {
+            "running": self.running,
+            "elapsed_seconds": round(elapsed, 1),
+            "fetched": self.fetched,
+            "skipped": self.skipped,
+            "embedded": self.embedded,
+            "upserted": self.upserted,
+            "metadata_updated": self.metadata_updated,
+            "tokens": self.tokens,
+            "embeddings_saved": self.embeddings_saved,
+            "tokens_saved": self.tokens_saved,
+            "upserts_per_second": round(self.upserted / elapsed, 1) if elapsed > 0 else 0.0,
+            "error": self.error
+        }
+
+
+class IndexPipeline:
+    """ Overlaps fetching, embedding and upserting with bounded queues between the stages.
+
+    Each stage runs its own pool of workers, so a full reindex runs at the pace of the slowest stage
+    while the queues cap how many packages are held in memory at once. Upserted packages are appended
+    to an optional checkpoint file and skipped when the same job is re-run after a failure.
+
+    With an EmbeddingStore, packages whose embed string is unchanged only get a metadata update, and
+    text that has been embedded before reuses the stored vector instead of calling OpenAI. A LexicalIndex
+    is kept in step with every batch written and saved once the run ends, the NeighbourIndex stages every
+    vector written for refresh_neighbours(), and every fetched package is mirrored into the PackageCatalogue.
+    """
+    embed_batch_size: int
+    upsert_batch_size: int
+    embed_concurrency: int
+    upsert_concurrency: int
+    queue_size: int
+    checkpoint_path: Optional[str]
+
+    def __init__(self,
+                 openai_service: OpenAiService,
+                 pinecone_service: PineconeService,
+                 embed_batch_size: int = 256,
+                 upsert_batch_size: int = 1000,
+                 embed_concurrency: int = 2,
+                 upsert_concurrency: int = 2,
+                 queue_size: int = 4,
+                 checkpoint_path: Optional[str] = None,
+                 embedding_store: Optional[EmbeddingStore] = None,
+                 lexical_index: Optional[LexicalIndex] = None,
+                 neighbour_index: Optional[NeighbourIndex] = None,
+                 catalogue: Optional[PackageCatalogue] = None):
+        self._openai_service = openai_service
+        self._pinecone_service = pinecone_service
+        self._embedding_store = embedding_store
+        self._lexical_index = lexical_index
+        self._neighbour_index = neighbour_index
+        self._catalogue = catalogue
+        self.embed_batch_size = embed_batch_size
+        self.upsert_batch_size = upsert_batch_size
+        self.embed_concurrency = embed_concurrency
+        self.upsert_concurrency = upsert_concurrency
+        self.queue_size = queue_size
+        self.checkpoint_path = checkpoint_path
+        self.progress = IndexProgress()
+
+    async def run(self, pages: AsyncIterator[list[dict]]) -> IndexProgress:
+        """ Index every package yielded by pages, returning the final progress counters. """
+        self.progress = IndexProgress()
+        completed = self._load_checkpoint()
+        embed_queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        upsert_queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+
+        async def fetch_stage():
+            batch = []
+            async for page in pages:
+                self.progress.fetched += len(page)
+                # Until a full crawl has seeded the catalogue it's left alone, a partial one would look complete.
+                if self._catalogue is not None and await asyncio.to_thread(self._catalogue.is_seeded):
+                    await asyncio.to_thread(self._catalogue.upsert, page)
+                for package in page:
+                    if completed.get(package["FullIdent"]) == to_timestamp(package["Updated"]):
+                        self.progress.skipped += 1
+                        continue
+                    batch.append(package)
+                    if len(batch) == self.embed_batch_size:
+                        await embed_queue.put(batch)
+                        batch = []
+            if batch:
+                await embed_queue.put(batch)
+
+        async def embed_stage():
+            while (packages := await embed_queue.get()) is not None:
+                embed_strings = [get_embed_string(package) for package in packages]
+                if self._embedding_store is None:
+                    with timed("index_embed"):
+                        embeddings_list, tokens = await asyncio.to_thread(self._openai_service.get_embeddings, embed_strings)
+                    self.progress.embedded += len(packages)
+                    INDEXED_PACKAGES.inc(len(packages), operation="embedded")
+                    self.progress.tokens += tokens
+                    vectors = [get_pinecone_vector_from_package(embeddings_list[i], package)
+                               for i, package in enumerate(packages)]
+                    for i in range(0, len(vectors), self.upsert_batch_size):
+                        await upsert_queue.put(("upsert", vectors[i:i+self.upsert_batch_size], None))
+                    continue
+
+                with timed("index_embed"):
+                    upserts, metadata_updates = await asyncio.to_thread(self._resolve_embeddings, packages, embed_strings)
+                for i in range(0, len(upserts), self.upsert_batch_size):
+                    await upsert_queue.put(("upsert", *zip(*upserts[i:i+self.upsert_batch_size])))
+                for i in range(0, len(metadata_updates), self.upsert_batch_size):
+                    await upsert_queue.put(("metadata", *zip(*metadata_updates[i:i+self.upsert_batch_size])))
+
+        def record(kind: str, vectors: list[PineconeVector], hashes: Optional[dict[str, str]]):
+            """ Book-keeping for vectors the index has acknowledged, run on the upsert thread. """
+            if kind == "upsert":
+                self.progress.upserted += len(vectors)
+            else:
+                self.progress.metadata_updated += len(vectors)
+            INDEXED_PACKAGES.inc(len(vectors), operation="upserted" if kind == "upsert" else "metadata_updated")
+            if hashes is not None:
+                self._embedding_store.mark_indexed([(vector.id, hashes[vector.id]) for vector in vectors])
+            if self._lexical_index is not None:
+                self._lexical_index.update(vectors, persist=False)
+            if self._neighbour_index is not None:
+                self._neighbour_index.update(vectors)
+            self._append_checkpoint(vectors)
+
+        async def upsert_stage():
+            while (item := await upsert_queue.get()) is not None:
+                kind, vectors, hashes = item
+                vectors = list(vectors)
+                hashes = dict(zip((vector.id for vector in vectors), hashes)) if hashes is not None else None
+                with timed("index_upsert"):
+                    if kind == "upsert":
+                        # Checkpointed per acknowledged request batch, so a failed run resumes after the last one.
+                        await asyncio.to_thread(self._pinecone_service.upsert_embeddings, vectors,
+                                                lambda batch: record(kind, batch, hashes))
+                    else:
+                        await asyncio.to_thread(self._pinecone_service.update_metadata, vectors)
+                        await asyncio.to_thread(record, kind, vectors, hashes)
+
+        async def close(queue: asyncio.Queue, workers: list[asyncio.Task], stage: asyncio.Future):
+            await stage
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+
+        embed_workers = [asyncio.create_task(embed_stage()) for _ in range(self.embed_concurrency)]
+        upsert_workers = [asyncio.create_task(upsert_stage()) for _ in range(self.upsert_concurrency)]
+        fetcher = asyncio.create_task(fetch_stage())
+        embedding_done = asyncio.create_task(close(embed_queue, embed_workers, fetcher))
+        upserting_done = asyncio.create_task(close(upsert_queue, upsert_workers, embedding_done))
+        tasks = [fetcher, embedding_done, upserting_done, *embed_workers, *upsert_workers]
+
+        try:
+            # Fail fast: if any stage raises, stop the rest instead of waiting on a full queue forever.
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if task.exception() is not None:
+                    raise task.exception()
+        except BaseException as e:
+            self.progress.error = str(e) or type(e).__name__
+            raise
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # The vector service persists once per run, not once per batch.
+            await asyncio.to_thread(self._pinecone_service.save)
+            if self._lexical_index is not None:
+                await asyncio.to_thread(self._lexical_index.save)
+            self.progress.finished_at = time.time()
+
+        self._clear_checkpoint()
+        return self.progress
+
+    def refresh_neighbours(self):
+        """ Fold the vectors staged by past runs into the neighbour table, seeding it from the whole index the
+        first time. This scores every changed package against the corpus, so run it in the background. """
+        if self._neighbour_index is None:
+            return
+        # A table built from staged vectors alone would never be seeded with the rest of the index.
+        self._neighbour_index.ensure_seeded(self._pinecone_service.iter_vectors)
+        self._neighbour_index.refresh()
+
+    def _resolve_embeddings(self,
+                            packages: list[dict],
+                            embed_strings: list[str]) -> tuple[list[tuple[PineconeVector, str]], list[tuple[PineconeVector, str]]]:
+        """ Split a batch into (vector, hash) pairs needing a full upsert and ones needing only a metadata update,
+        embedding through OpenAI only the text the store has never seen. """
+        store = self._embedding_store
+        hashes = [store.content_hash(text) for text in embed_strings]
+        indexed = store.indexed_hashes([package["FullIdent"] for package in packages])
+        stored = store.get_many(list(set(hashes)))
+
+        to_embed = {content_hash: text for content_hash, text in zip(hashes, embed_strings)
+                    if content_hash not in stored}
+        if to_embed:
+            texts = list(to_embed.values())
+            embeddings_list, tokens = self._openai_service.get_embeddings(texts)
+            new_entries = [(content_hash, embedding, entry_tokens) for content_hash, embedding, entry_tokens
+                           in zip(to_embed, embeddings_list, apportion_tokens(texts, tokens))]
+            store.put_many(new_entries)
+            stored.update({content_hash: (embedding, entry_tokens) for content_hash, embedding, entry_tokens in new_entries})
+            self.progress.embedded += len(texts)
+            self.progress.tokens += tokens
+            INDEXED_PACKAGES.inc(len(texts), operation="embedded")
+
+        upserts, metadata_updates = [], []
+        for package, content_hash in zip(packages, hashes):
+            embedding, tokens = stored[content_hash]
+            if content_hash not in to_embed:
+                self.progress.embeddings_saved += 1
+                self.progress.tokens_saved += tokens
+                INDEXED_PACKAGES.inc(operation="embedding_reused")
+
+            if indexed.get(package["FullIdent"]) == content_hash:
+                metadata_updates.append((get_pinecone_vector_from_package([], package), content_hash))
+            else:
+                upserts.append((get_pinecone_vector_from_package(embedding, package), content_hash))
+            # Only the first package with freshly embedded text paid for it, duplicates later in the batch reuse it.
+            to_embed.pop(content_hash, None)
+
+        return upserts, metadata_updates
+
+    def _load_checkpoint(self) -> dict[str, int]:
+        """ FullIdent -> Updated timestamp of every package upserted by an unfinished previous run. """
+        completed = {}
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return completed
+
+        with open(self.checkpoint_path) as f:
+            for line in f:
+                try:
+                    completed.update(json.loads(line))
+                except json.JSONDecodeError:
+                    # A crash mid-write leaves a torn last line, everything before it is still valid.
+                    break
+        return completed
+
+    def _append_checkpoint(self, vectors: list):
+        if not self.checkpoint_path:
+            return
+        with open(self.checkpoint_path, "a") as f:
+            f.write(json.dumps({vector.id: vector.metadata["Updated"] for vector in vectors}) + "\n")
+
+    def _clear_checkpoint(self):
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
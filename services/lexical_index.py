@@ -0,0 +1,225 @@
+import heapq
+import json
+import math
+import re
+import threading
+from bisect import bisect_left
+from collections import Counter
+from typing import Callable, Iterable, Optional
+
+from models import PineconeVector
+from .sidecar import Sidecar
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> list[str]:
+    return _TOKEN_PATTERN.findall(text.lower())
+
+
+class LexicalIndex:
+    """ BM25 inverted index over package Title, Summary, Tags and FullIdent, persisted to a local sidecar file.
+
+    Documents are the same metadata dicts stored alongside the vectors, so lexical hits can be returned
+    without touching the vector index. Postings are rebuilt in memory from the sidecar on load.
+    Until it has been seeded with the whole index, or loaded from a sidecar that was, updates are held
+    back and nothing is searched or saved, so a partial index never passes for a complete one. Lookups
+    never reload the sidecar themselves; the server calls reload_if_changed() in the background.
+    """
+    path: Optional[str]
+    k1: float
+    b: float
+
+    def __init__(self, path: Optional[str] = None, k1: float = 1.2, b: float = 0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        self._seed_lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._documents: dict[str, dict] = {}
+        self._terms: dict[str, Counter] = {}
+        self._postings: dict[str, dict[str, int]] = {}
+        self._lengths: dict[str, int] = {}
+        self._total_length = 0
+        self._sorted_idents: Optional[list[tuple[str, str]]] = None
+        self._pending: dict[str, dict] = {}
+        self._seeded = False
+        self._sidecar = Sidecar(path)
+
+        if path:
+            self.reload_if_changed()
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+    @property
+    def seeded(self) -> bool:
+        return self._seeded
+
+    @classmethod
+    def document_terms(cls, metadata: dict) -> Counter:
+        text = [metadata.get("Title") or "", metadata.get("Summary") or "", " ".join(metadata.get("Tags") or [])]
+        ident = metadata.get("FullIdent") or ""
+        # The whole ident is a term too, so "facepunch.sandbox" matches itself and not every facepunch package.
+        return Counter(tokenize(" ".join(text + [ident])) + ([ident.lower()] if ident else []))
+
+    @staticmethod
+    def query_terms(query: str) -> list[str]:
+        terms = tokenize(query)
+        terms.extend(word for word in query.lower().split() if "." in word)
+        return terms
+
+    def update(self, vectors: list[PineconeVector], persist: bool = True):
+        """ Index or re-index the text of upserted vectors. """
+        with self._lock:
+            if not self._seeded:
+                self._pending.update((vector.id, dict(vector.metadata)) for vector in vectors)
+                return
+            for vector in vectors:
+                self._add(vector.id, dict(vector.metadata))
+            self._sorted_idents = None
+
+        if persist:
+            self.save()
+
+    def _add(self, ident: str, metadata: dict):
+        self._remove(ident)
+        terms = self.document_terms(metadata)
+        self._documents[ident] = metadata
+        self._terms[ident] = terms
+        self._lengths[ident] = sum(terms.values())
+        self._total_length += self._lengths[ident]
+        for term, frequency in terms.items():
+            self._postings.setdefault(term, {})[ident] = frequency
+
+    def _remove(self, ident: str):
+        terms = self._terms.pop(ident, None)
+        if terms is None:
+            return
+        del self._documents[ident]
+        self._total_length -= self._lengths.pop(ident)
+        for term in terms:
+            postings = self._postings[term]
+            del postings[ident]
+            if not postings:
+                del self._postings[term]
+
+    def ensure_seeded(self, iter_vectors: Callable[[], Iterable[list[PineconeVector]]]):
+        """ Build the index from every vector in the backend, unless it's seeded or its sidecar already was.
+
+        The sidecar's file lock lets one worker on the host build it while the others wait and load the result.
+        """
+        if self._seeded:
+            return
+        with self._seed_lock, self._sidecar.exclusive():
+            self.reload_if_changed()
+            if self._seeded:
+                return
+            built = LexicalIndex(k1=self.k1, b=self.b)
+            for batch in iter_vectors():
+                for vector in batch:
+                    built._add(vector.id, dict(vector.metadata))
+            self._adopt(built)
+            self.save()
+            print(f"Built lexical index with {len(self._documents)} packages")
+
+    def _adopt(self, built: "LexicalIndex"):
+        """ Swap in a fully built index, then apply the updates held back while it wasn't seeded. """
+        with self._lock:
+            self._documents, self._terms, self._postings = built._documents, built._terms, built._postings
+            self._lengths, self._total_length = built._lengths, built._total_length
+            for ident, metadata in self._pending.items():
+                self._add(ident, metadata)
+            self._pending.clear()
+            self._sorted_idents = None
+            self._seeded = True
+
+    def _matches_type(self, ident: str, type_filter: list[str]) -> bool:
+        return not type_filter or self._documents[ident].get("Type") in type_filter
+
+    def search(self, query: str, take: int, type_filter: list[str] = []) -> list[dict]:
+        """ The take best BM25 matches for query as {"id", "metadata"} dicts, best first. """
+        with self._lock:
+            if not self._documents or take <= 0:
+                return []
+
+            count = len(self._documents)
+            average_length = self._total_length / count
+            scores: dict[str, float] = {}
+            for term in set(self.query_terms(query)):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for ident, frequency in postings.items():
+                    norm = frequency + self.k1 * (1 - self.b + self.b * self._lengths[ident] / average_length)
+                    scores[ident] = scores.get(ident, 0.0) + idf * frequency * (self.k1 + 1) / norm
+
+            if type_filter:
+                scores = {ident: score for ident, score in scores.items() if self._matches_type(ident, type_filter)}
+            best = heapq.nlargest(take, scores.items(), key=lambda item: (item[1], item[0]))
+            return [{"id": ident, "metadata": self._documents[ident]} for ident, _ in best]
+
+    def ident_matches(self, query: str, take: int, type_filter: list[str] = []) -> list[dict]:
+        """ Packages whose FullIdent equals or starts with query, exact match first, for ident-shaped queries. """
+        prefix = query.strip().lower()
+        if not prefix or any(character.isspace() for character in prefix):
+            return []
+
+        with self._lock:
+            if self._sorted_idents is None:
+                self._sorted_idents = sorted((ident.lower(), ident) for ident in self._documents)
+
+            # Bare words like "gun" would prefix-match far too much, only dotted queries look like idents.
+            exact_only = "." not in prefix
+            matches = []
+            for lowered, ident in self._sorted_idents[bisect_left(self._sorted_idents, (prefix, "")):]:
+                if len(matches) >= take or not lowered.startswith(prefix):
+                    break
+                if exact_only and lowered != prefix:
+                    break
+                if self._matches_type(ident, type_filter):
+                    matches.append(ident)
+
+            return [{"id": ident, "metadata": self._documents[ident]} for ident in matches]
+
+    def _clear(self):
+        self._documents.clear()
+        self._terms.clear()
+        self._postings.clear()
+        self._lengths.clear()
+        self._total_length = 0
+        self._sorted_idents = None
+
+    def clear(self):
+        # An empty index is a complete copy of an empty vector index.
+        with self._lock:
+            self._clear()
+            self._pending.clear()
+            self._seeded = True
+        self.save()
+
+    def save(self):
+        """ Write the documents to the sidecar, postings are rebuilt from them on load. """
+        # Stored metadata dicts are replaced rather than mutated, so a shallow copy is a stable snapshot
+        # and searches aren't held up while it's serialized.
+        with self._save_lock:
+            with self._lock:
+                if not self._seeded:
+                    return
+                documents = dict(self._documents)
+            self._sidecar.write(lambda f: json.dump(documents, f), mode="w")
+
+    def reload_if_changed(self):
+        """ Load the sidecar if another worker has rewritten it. """
+        self._sidecar.reload_if_changed(self._load)
+
+    def _load(self, path: str):
+        with open(path) as f:
+            documents = json.load(f)
+        # Built aside and swapped in, so searches keep using the old postings meanwhile.
+        loaded = LexicalIndex(k1=self.k1, b=self.b)
+        for ident, metadata in documents.items():
+            loaded._add(ident, metadata)
+        self._adopt(loaded)
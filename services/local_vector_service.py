@@ -0,0 +1,412 @@
+import asyncio
+import threading
+from typing import Callable, Iterator, NamedTuple, Optional
+
+import numpy as np
+
+from models import PineconeVector
+from .quantization import Int8Quantizer, ProductQuantizer, create_quantizer, fit_sample
+from .sidecar import Sidecar
+from .vector_snapshot import SnapshotWriter, VectorSnapshot
+
+
+class _IndexView(NamedTuple):
+    """ A consistent read of the index: writers grow by allocating new arrays, so these stay valid to size. """
+    size: int
+    vectors: np.ndarray
+    ids: np.ndarray
+    metadata: dict[str, np.ndarray]
+    quantizer: Optional[Int8Quantizer | ProductQuantizer]
+    codes: Optional[np.ndarray]
+    prefix: Optional[np.ndarray]
+
+
+class LocalVectorService:
+    """ In-process vector index with the same interface as PineconeService.
+
+    Searches can run in two stages: a coarse pass over int8/pq codes (quantization) and/or over the first
+    prefix_dimensions of each vector, then an exact re-rank of the best (take + skip) * rerank_factor candidates
+    against the full float vectors, which are then only read for those rows.
+    """
+    METADATA_FIELDS = ("Title", "FullIdent", "Tags", "Summary", "Type", "Thumb", "Updated", "Created")
+    TIMESTAMP_FIELDS = ("Updated", "Created")
+    path: Optional[str]
+    embedding_model: Optional[str]
+    quantization: Optional[str]
+    prefix_dimensions: Optional[int]
+    rerank_factor: int
+    index_version: int
+
+    def __init__(self,
+                 path: Optional[str] = None,
+                 embedding_model: Optional[str] = None,
+                 quantization: Optional[str] = None,
+                 rerank_factor: int = 4,
+                 prefix_dimensions: Optional[int] = None):
+        if quantization:
+            create_quantizer(quantization)
+        self.path = path
+        self.embedding_model = embedding_model
+        self.quantization = quantization or None
+        # text-embedding-3 vectors are trained so a leading slice is itself a usable, coarser embedding.
+        self.prefix_dimensions = prefix_dimensions or None
+        self.rerank_factor = max(1, rerank_factor)
+        self.index_version = 0
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._sidecar = Sidecar(path)
+        self._reset()
+
+        if path:
+            self._reload_if_changed()
+
+    def _reset(self, dimension: int = 0, capacity: int = 0):
+        self._size = 0
+        self._vectors = np.zeros((capacity, dimension), dtype=np.float32)
+        self._ids = np.empty(capacity, dtype=object)
+        self._metadata = {field: self._empty_column(field, capacity) for field in self.METADATA_FIELDS}
+        self._id_to_row: dict[str, int] = {}
+        self._quantizer: Optional[Int8Quantizer | ProductQuantizer] = None
+        self._codes: Optional[np.ndarray] = None
+        self._prefix: Optional[np.ndarray] = None
+
+    def _empty_column(self, field: str, capacity: int) -> np.ndarray:
+        if field in self.TIMESTAMP_FIELDS:
+            return np.zeros(capacity, dtype=np.int64)
+        return np.empty(capacity, dtype=object)
+
+    @property
+    def dimension(self) -> int:
+        return self._vectors.shape[1]
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _is_writeable(self) -> bool:
+        codes_writeable = self._codes is None or self._codes.flags.writeable
+        return self._vectors.flags.writeable and codes_writeable and \
+            all(column.flags.writeable for column in self._metadata.values())
+
+    def _grow(self, required: int, dimension: int):
+        """ Grow the backing arrays geometrically so appends stay amortised O(1). """
+        if self.dimension == 0:
+            self._reset(dimension, max(required, 1024))
+            return
+        if dimension != self.dimension:
+            raise ValueError(f"Vector dimension {dimension} does not match index dimension {self.dimension}")
+        if required <= len(self._vectors) and self._is_writeable():
+            return
+
+        # Memory-mapped snapshot arrays are read-only, so the first write copies them out.
+        capacity = max(required, len(self._vectors) * 2, 1024)
+        vectors = np.zeros((capacity, dimension), dtype=np.float32)
+        vectors[:self._size] = self._vectors[:self._size]
+        ids = np.empty(capacity, dtype=object)
+        ids[:self._size] = self._ids[:self._size]
+        for field, column in self._metadata.items():
+            grown = self._empty_column(field, capacity)
+            grown[:self._size] = column[:self._size]
+            self._metadata[field] = grown
+        if self._codes is not None:
+            codes = np.zeros((capacity, self._codes.shape[1]), dtype=self._codes.dtype)
+            codes[:self._size] = self._codes[:self._size]
+            self._codes = codes
+        if self._prefix is not None:
+            prefix = np.zeros((capacity, self._prefix.shape[1]), dtype=np.float32)
+            prefix[:self._size] = self._prefix[:self._size]
+            self._prefix = prefix
+        self._vectors = vectors
+        self._ids = ids
+
+    def _prefix_rows(self, vectors: np.ndarray) -> np.ndarray:
+        prefix = np.array(vectors[:, :self.prefix_dimensions], dtype=np.float32)
+        norms = np.linalg.norm(prefix, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return prefix / norms
+
+    def _coarse_vectors(self) -> np.ndarray:
+        """ The rows the coarse stage scores, or the quantizer encodes: the prefix slice if set, else full vectors. """
+        return self._prefix if self.prefix_dimensions else self._vectors
+
+    def _coarse_ready(self) -> bool:
+        return (not self.prefix_dimensions or self._prefix is not None) and \
+            (not self.quantization or self._codes is not None)
+
+    def _ensure_coarse(self):
+        """ Build the prefix rows and fit and encode the quantizer, once, on first search. """
+        if self._coarse_ready() or not self._size:
+            return
+        with self._lock:
+            if self.prefix_dimensions and self._prefix is None:
+                self._prefix = np.zeros((len(self._vectors), min(self.prefix_dimensions, self.dimension)),
+                                        dtype=np.float32)
+                self._prefix[:self._size] = self._prefix_rows(self._vectors[:self._size])
+            if self.quantization and self._codes is None:
+                vectors = self._coarse_vectors()[:self._size]
+                if self._quantizer is None:
+                    self._quantizer = create_quantizer(self.quantization).fit(fit_sample(vectors))
+                codes = self._quantizer.encode(vectors)
+                self._codes = np.zeros((len(self._vectors), codes.shape[1]), dtype=codes.dtype)
+                self._codes[:self._size] = codes
+
+    def _view(self) -> _IndexView:
+        """ Capture the size and arrays once, so a search never mixes them with a concurrent upsert's. """
+        with self._lock:
+            return _IndexView(self._size, self._vectors, self._ids, dict(self._metadata),
+                              self._quantizer, self._codes, self._prefix)
+
+    def upsert_embeddings(self,
+                          data: list[PineconeVector],
+                          on_batch: Optional[Callable[[list[PineconeVector]], None]] = None):
+        """ Insert or replace vectors, keeping rows unit-normalised for cosine scoring. Call save() to persist. """
+        if not data:
+            return
+
+        with self._lock:
+            self._grow(self._size + len(data), len(data[0].values))
+            rows = []
+            for vector in data:
+                row = self._id_to_row.get(vector.id)
+                if row is None:
+                    row = self._size
+                    self._size += 1
+                    self._id_to_row[vector.id] = row
+                rows.append(row)
+
+                values = np.asarray(vector.values, dtype=np.float32)
+                norm = np.linalg.norm(values)
+                self._vectors[row] = values / norm if norm > 0 else values
+                self._ids[row] = vector.id
+                for field, column in self._metadata.items():
+                    column[row] = vector.metadata.get(field, 0 if field in self.TIMESTAMP_FIELDS else None)
+            if self._prefix is not None:
+                self._prefix[rows] = self._prefix_rows(self._vectors[rows])
+            if self._codes is not None:
+                # Only the changed rows are re-encoded; the quantizer keeps the scales it was fitted with.
+                self._codes[rows] = self._quantizer.encode(self._coarse_vectors()[rows])
+            self.index_version += 1
+
+        if on_batch is not None:
+            on_batch(data)
+
+    def update_metadata(self, data: list[PineconeVector]):
+        """ Replace the metadata of existing vectors, leaving their values untouched. Call save() to persist. """
+        if self._size == 0:
+            return
+
+        with self._lock:
+            self._grow(self._size, self.dimension)
+            for vector in data:
+                row = self._id_to_row.get(vector.id)
+                if row is None:
+                    continue
+                for field, column in self._metadata.items():
+                    if field in vector.metadata:
+                        column[row] = vector.metadata[field]
+            self.index_version += 1
+
+    def _filter_mask(self, view: _IndexView, filter_dict: dict) -> Optional[np.ndarray]:
+        """ Evaluate a Pinecone-style metadata filter as a boolean row mask. """
+        if not filter_dict:
+            return None
+
+        mask = np.ones(view.size, dtype=bool)
+        for field, condition in filter_dict.items():
+            if field not in view.metadata:
+                raise ValueError(f"Unsupported filter field {field}")
+            column = view.metadata[field][:view.size]
+            if not isinstance(condition, dict):
+                condition = {"$eq": condition}
+
+            for operator, value in condition.items():
+                if operator == "$in":
+                    if field == "Tags":
+                        wanted = set(value)
+                        mask &= np.fromiter((bool(wanted.intersection(tags or [])) for tags in column), dtype=bool, count=view.size)
+                    else:
+                        mask &= np.isin(column, list(value))
+                elif operator == "$nin":
+                    mask &= ~np.isin(column, list(value))
+                elif operator == "$eq":
+                    mask &= column == value
+                elif operator == "$ne":
+                    mask &= column != value
+                elif operator == "$gte":
+                    mask &= column >= value
+                elif operator == "$gt":
+                    mask &= column > value
+                elif operator == "$lte":
+                    mask &= column <= value
+                elif operator == "$lt":
+                    mask &= column < value
+                else:
+                    raise ValueError(f"Unsupported filter operator {operator}")
+
+        return mask
+
+    def _top_k(self, scores: np.ndarray, k: int) -> np.ndarray:
+        """ Indices of the k highest scores in descending order. """
+        k = min(k, int(np.count_nonzero(scores > -np.inf)))
+        if k <= 0:
+            return np.empty(0, dtype=np.int64)
+        if k < len(scores):
+            candidates = np.argpartition(-scores, k - 1)[:k]
+        else:
+            candidates = np.arange(len(scores))
+        return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+    def _row_metadata(self, view: _IndexView, row: int) -> dict:
+        return {field: column[row].item() if field in self.TIMESTAMP_FIELDS else column[row]
+                for field, column in view.metadata.items()}
+
+    def _to_vector(self, view: _IndexView, row: int, include_values: bool) -> PineconeVector:
+        return PineconeVector(
+            id=view.ids[row],
+            values=view.vectors[row].tolist() if include_values else [],
+            metadata=self._row_metadata(view, row)
+        )
+
+    def search_pinecone(self,
+                        embedding: list[float],
+                        take: int,
+                        skip: int,
+                        filter_dict: dict) -> list[dict]:
+        """ Cosine search the local index, returning {"id", "metadata"} matches in rank order. """
+        self._reload_if_changed()
+        if self.quantization or self.prefix_dimensions:
+            self._ensure_coarse()
+        view = self._view()
+        if view.size == 0:
+            return []
+
+        query = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm > 0:
+            query = query / norm
+
+        # A reload or delete between the coarse build and the view drops the coarse rows, so score exactly then.
+        coarse_ready = (not self.quantization or view.codes is not None) and \
+            (not self.prefix_dimensions or view.prefix is not None)
+        if (self.quantization or self.prefix_dimensions) and coarse_ready:
+            rows = self._search_two_stage(view, query, take, skip, filter_dict)
+        else:
+            scores = view.vectors[:view.size] @ query
+            mask = self._filter_mask(view, filter_dict)
+            if mask is not None:
+                scores[~mask] = -np.inf
+            rows = self._top_k(scores, take + skip)[skip:]
+        return [{"id": view.ids[row], "metadata": self._row_metadata(view, row)} for row in rows]
+
+    def _search_two_stage(self,
+                          view: _IndexView,
+                          query: np.ndarray,
+                          take: int,
+                          skip: int,
+                          filter_dict: dict) -> np.ndarray:
+        coarse_query = query
+        if self.prefix_dimensions:
+            coarse_query = query[:self.prefix_dimensions]
+            norm = np.linalg.norm(coarse_query)
+            if norm > 0:
+                coarse_query = coarse_query / norm
+        if self.quantization:
+            scores = view.quantizer.scores(coarse_query, view.codes[:view.size])
+        else:
+            scores = view.prefix[:view.size] @ coarse_query
+        mask = self._filter_mask(view, filter_dict)
+        if mask is not None:
+            scores[~mask] = -np.inf
+
+        # Sorted so the re-rank reads the (possibly memory-mapped) float rows in file order.
+        candidates = np.sort(self._top_k(scores, (take + skip) * self.rerank_factor))
+        exact = view.vectors[candidates] @ query
+        return candidates[np.argsort(-exact, kind="stable")][skip:skip+take]
+
+    async def search_pinecone_async(self,
+                                    embedding: list[float],
+                                    take: int,
+                                    skip: int,
+                                    filter_dict: dict) -> list[dict]:
+        """ search_pinecone off the event loop; NumPy releases the GIL while scoring. """
+        return await asyncio.to_thread(self.search_pinecone, embedding, take, skip, filter_dict)
+
+    def iter_vectors(self, batch_size: int = 100) -> Iterator[list[PineconeVector]]:
+        """ Yield every vector in the index in batches. """
+        view = self._view()
+        for start in range(0, view.size, batch_size):
+            yield [self._to_vector(view, row, include_values=True) for row in range(start, min(start + batch_size, view.size))]
+
+    def _fetch_recent(self, field: str, take: int) -> list[PineconeVector]:
+        self._reload_if_changed()
+        view = self._view()
+        timestamps = view.metadata[field][:view.size].astype(np.float64)
+        return [self._to_vector(view, row, include_values=False) for row in self._top_k(timestamps, take)]
+
+    def fetch_recently_created_packages(self, take: int) -> list[PineconeVector]:
+        return self._fetch_recent("Created", take)
+
+    def fetch_recently_updated_packages(self, take: int) -> list[PineconeVector]:
+        return self._fetch_recent("Updated", take)
+
+    def delete_index(self):
+        """ Delete every vector from the local index """
+        with self._lock:
+            self._reset()
+            self.index_version += 1
+
+        if self.path:
+            self.save()
+
+    def save(self):
+        """ Atomically persist the index to self.path as a vector snapshot. """
+        if not self.path:
+            return
+        # Written from a view, so searches and upserts aren't blocked for the length of the write.
+        with self._save_lock:
+            view = self._view()
+            # Snapshot codes always encode full vectors, so prefix-stage codes are rebuilt on load instead.
+            quantizer = (view.quantizer or create_quantizer(self.quantization)) \
+                if self.quantization and not self.prefix_dimensions else None
+            with SnapshotWriter(self.path, self.embedding_model, view.vectors.shape[1], quantizer=quantizer) as writer:
+                if view.size:
+                    writer.write_columns(
+                        view.ids[:view.size].tolist(),
+                        view.vectors[:view.size],
+                        {field: column[:view.size].tolist() for field, column in view.metadata.items()}
+                    )
+            self._sidecar.mark_loaded()
+
+    def _reload_if_changed(self):
+        """ Open the snapshot if it's new or another worker has rewritten it, memory-mapping its vector block. """
+        self._sidecar.reload_if_changed(lambda path: self.load_snapshot(VectorSnapshot(path)))
+
+    def warm_up(self):
+        """ Fit the quantizer and build the prefix rows now instead of on the first search. """
+        self._reload_if_changed()
+        self._ensure_coarse()
+
+    def load_snapshot(self, snapshot: VectorSnapshot):
+        if self.embedding_model and snapshot.model and snapshot.model != self.embedding_model:
+            raise ValueError(f"Snapshot was built with {snapshot.model}, expected {self.embedding_model}")
+
+        vectors = snapshot.vectors
+        if vectors.dtype != np.float32:
+            # float16 snapshots are widened once at load; float32 ones stay zero-copy.
+            vectors = vectors.astype(np.float32)
+
+        with self._lock:
+            self._size = snapshot.count
+            self._vectors = vectors
+            self._ids = np.fromiter(snapshot.ids, dtype=object, count=snapshot.count)
+            self._metadata = {
+                field: snapshot.columns[field] if field in self.TIMESTAMP_FIELDS
+                else np.fromiter(snapshot.columns[field], dtype=object, count=snapshot.count)
+                for field in self.METADATA_FIELDS
+            }
+            self._id_to_row = {ident: row for row, ident in enumerate(snapshot.ids)}
+            # Codes stored in the snapshot are reused as-is; otherwise they are rebuilt on the next search.
+            same_kind = self.quantization and snapshot.quantization == self.quantization and not self.prefix_dimensions
+            self._quantizer = snapshot.quantizer if same_kind else None
+            self._codes = snapshot.codes if same_kind else None
+            self._prefix = None
+            self.index_version += 1
@@ -0,0 +1,312 @@
+import json
+import os
+import threading
+from itertools import islice
+from typing import Callable, Iterable, Optional
+
+import numpy as np
+
+from models import PineconeVector
+from utils import normalize_query
+from .sidecar import Sidecar
+
+
+class NeighbourIndex:
+    """ Precomputed nearest neighbours of every indexed package, plus a title prefix table for autocomplete.
+
+    The indexer stages the vectors it writes and refresh() folds them in with one batched pass: changed rows
+    are scored against the whole corpus a block at a time, rows that listed a changed package are recomputed,
+    and every other row only merges in changed packages that now beat its k-th neighbour. Lookups read the
+    table, so they need no embedding or vector query. The table is persisted to a sidecar .npz file; its unit
+    vectors are only read back by the process that refreshes it.
+    """
+    BLOCK_ROWS = 1024
+    # Past this share of changed rows it is cheaper to recompute every row than to work out which are affected.
+    FULL_REFRESH_FRACTION = 0.25
+    # Prefixes up to this length map straight to their completions, longer ones filter that bucket.
+    MAX_PREFIX_LENGTH = 8
+    MAX_COMPLETIONS = 32
+    path: Optional[str]
+    neighbours: int
+
+    def __init__(self, path: Optional[str] = None, neighbours: int = 20):
+        self.path = path
+        self.neighbours = neighbours
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._seed_lock = threading.Lock()
+        self._pending: dict[str, tuple[Optional[np.ndarray], dict]] = {}
+        self._sidecar = Sidecar(path)
+        self._set_state([], [], np.full((0, neighbours), -1, dtype=np.int32),
+                        np.full((0, neighbours), -np.inf, dtype=np.float32), None, {})
+
+        if path:
+            self.reload_if_changed()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def _set_state(self, ids: list[str], metadata: list[dict], neighbours: np.ndarray, scores: np.ndarray,
+                   vectors: Optional[np.ndarray], completions: dict[str, list[int]]):
+        self._ids = ids
+        self._rows = {ident: row for row, ident in enumerate(ids)}
+        self._metadata = metadata
+        self._table = neighbours
+        self._scores = scores
+        # Only kept in memory without a path; otherwise refresh() reads them back from the sidecar.
+        self._vectors = None if self.path else vectors
+        self._completions = completions
+
+    def update(self, vectors: list[PineconeVector]):
+        """ Stage upserted vectors, or metadata-only updates with empty values, for the next refresh(). """
+        with self._lock:
+            for vector in vectors:
+                values = None
+                if vector.values:
+                    values = np.asarray(vector.values, dtype=np.float32)
+                    norm = np.linalg.norm(values)
+                    if norm > 0:
+                        values = values / norm
+                elif vector.id in self._pending:
+                    values = self._pending[vector.id][0]
+                self._pending[vector.id] = (values, dict(vector.metadata))
+
+    def refresh(self):
+        """ Fold staged vectors into the neighbour table and persist it. """
+        with self._refresh_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+
+            if self.path and os.path.exists(self.path):
+                ids, metadata, table, scores, vectors = self._read(with_vectors=True)
+            else:
+                ids, metadata, table, scores, vectors = \
+                    list(self._ids), list(self._metadata), self._table, self._scores, self._vectors
+            rows = {ident: row for row, ident in enumerate(ids)}
+
+            changed = {}
+            for ident, (values, vector_metadata) in pending.items():
+                row = rows.get(ident)
+                if values is None:
+                    # Nothing to place a package by until it has been upserted with its vector.
+                    if row is not None:
+                        metadata[row] = vector_metadata
+                    continue
+                if row is None:
+                    row = rows[ident] = len(ids)
+                    ids.append(ident)
+                    metadata.append(vector_metadata)
+                else:
+                    metadata[row] = vector_metadata
+                changed[row] = values
+
+            if changed:
+                dimension = len(next(iter(changed.values())))
+                if vectors is not None and len(vectors) and vectors.shape[1] != dimension:
+                    raise ValueError(f"Neighbour index holds {vectors.shape[1]} dimensional vectors, got {dimension}")
+                matrix = np.zeros((len(ids), dimension), dtype=np.float32)
+                if vectors is not None and len(vectors):
+                    matrix[:len(vectors)] = vectors
+                for row, values in changed.items():
+                    matrix[row] = values
+                # Scored as stored, so a later incremental refresh agrees with this one.
+                vectors = matrix.astype(np.float16)
+                matrix[:] = vectors
+                table, scores = self._refresh_table(matrix, table, scores, np.array(sorted(changed)))
+
+            # Built before taking the lock, so lookups keep using the old table meanwhile.
+            completions = self._build_completions(metadata, table)
+            with self._lock:
+                self._set_state(ids, metadata, table, scores, vectors, completions)
+            self._save(vectors)
+            print(f"Refreshed neighbours of {len(changed)} changed packages out of {len(ids)}")
+
+    def _refresh_table(self,
+                       matrix: np.ndarray,
+                       table: np.ndarray,
+                       scores: np.ndarray,
+                       changed: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        count, k = len(matrix), self.neighbours
+        old_count = len(table)
+        is_changed = np.zeros(count, dtype=bool)
+        is_changed[changed] = True
+
+        new_table = np.full((count, k), -1, dtype=np.int32)
+        new_scores = np.full((count, k), -np.inf, dtype=np.float32)
+        if table.shape[1] != k or len(changed) > self.FULL_REFRESH_FRACTION * count:
+            recompute = np.arange(count)
+        else:
+            new_table[:old_count] = table
+            new_scores[:old_count] = scores
+            recompute = np.flatnonzero(is_changed | self._rescore_listed(matrix, new_table, new_scores, is_changed))
+        kept = np.setdiff1d(np.arange(count), recompute)
+
+        for start in range(0, len(recompute), self.BLOCK_ROWS):
+            block = recompute[start:start+self.BLOCK_ROWS]
+            block_scores = matrix[block] @ matrix.T
+            block_scores[np.arange(len(block)), block] = -np.inf
+            new_table[block], new_scores[block] = self._top(block_scores, k)
+            sources = is_changed[block]
+            if len(kept) and sources.any():
+                self._merge(new_table, new_scores, kept, block[sources], block_scores[sources][:, kept].T)
+        return new_table, new_scores
+
+    @staticmethod
+    def _rescore_listed(matrix: np.ndarray, table: np.ndarray, scores: np.ndarray, is_changed: np.ndarray) -> np.ndarray:
+        """ Re-score changed packages in the lists of unchanged rows, returning the rows that need recomputing.
+
+        A list stays exact while every changed entry still scores at least the old k-th score, since nothing
+        outside the list could beat that; otherwise a better package may be missing and the row is recomputed.
+        """
+        listed = (table >= 0) & is_changed[np.maximum(table, 0)] & ~is_changed[:, None]
+        rows, ranks = np.nonzero(listed)
+        if not len(rows):
+            return np.zeros(len(table), dtype=bool)
+        fresh = np.einsum("ij,ij->i", matrix[rows], matrix[table[rows, ranks]])
+        stale = np.zeros(len(table), dtype=bool)
+        stale[rows[fresh < scores[rows, -1]]] = True
+
+        scores[rows, ranks] = fresh
+        resort = np.setdiff1d(rows, np.flatnonzero(stale))
+        order = np.argsort(-scores[resort], axis=1, kind="stable")
+        table[resort] = np.take_along_axis(table[resort], order, axis=1)
+        scores[resort] = np.take_along_axis(scores[resort], order, axis=1)
+        return stale
+
+    @staticmethod
+    def _top(block_scores: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """ The k best columns of each row in descending order, padded with -1 where there are fewer. """
+        rows, columns = block_scores.shape
+        table = np.full((rows, k), -1, dtype=np.int32)
+        scores = np.full((rows, k), -np.inf, dtype=np.float32)
+        width = min(k, columns)
+        if width == 0:
+            return table, scores
+        candidates = np.argpartition(-block_scores, width - 1, axis=1)[:, :width]
+        candidate_scores = np.take_along_axis(block_scores, candidates, axis=1)
+        order = np.argsort(-candidate_scores, axis=1, kind="stable")
+        table[:, :width] = np.take_along_axis(candidates, order, axis=1)
+        scores[:, :width] = np.take_along_axis(candidate_scores, order, axis=1)
+        # The row itself scores -inf and only makes the cut when there are fewer than k other rows.
+        table[scores == -np.inf] = -1
+        return table, scores
+
+    def _merge(self, table: np.ndarray, scores: np.ndarray, kept: np.ndarray, sources: np.ndarray, cross: np.ndarray):
+        """ Merge changed rows (sources) into the lists of unchanged rows (kept) they now rank in. """
+        gains = np.flatnonzero((cross > scores[kept, -1:]).any(axis=1))
+        if not len(gains):
+            return
+        rows = kept[gains]
+        cross = cross[gains]
+        # Sources a row already lists were re-scored in place.
+        cross[(table[rows][:, :, None] == sources[None, None, :]).any(axis=1)] = -np.inf
+        candidates = np.concatenate([table[rows], np.broadcast_to(sources, (len(rows), len(sources)))], axis=1)
+        candidate_scores = np.concatenate([scores[rows], cross], axis=1)
+        order = np.argsort(-candidate_scores, axis=1, kind="stable")[:, :self.neighbours]
+        table[rows] = np.take_along_axis(candidates, order, axis=1)
+        scores[rows] = np.take_along_axis(candidate_scores, order, axis=1)
+
+    def ensure_seeded(self, iter_vectors: Callable[[], Iterable[list[PineconeVector]]]):
+        """ Build the table from every vector in the backend the first time it's needed. """
+        if len(self._ids) > 0:
+            return
+        with self._seed_lock:
+            self.reload_if_changed()
+            if len(self._ids) > 0:
+                return
+            for batch in iter_vectors():
+                self.update(batch)
+            self.refresh()
+
+    def similar(self, ident: str, take: int) -> Optional[list[dict]]:
+        """ Up to take nearest packages to ident as {"id", "metadata", "score"} dicts, None if it isn't indexed. """
+        with self._lock:
+            row = self._rows.get(ident)
+            if row is None:
+                return None
+            return [{"id": self._ids[neighbour], "metadata": self._metadata[neighbour], "score": float(score)}
+                    for neighbour, score in zip(self._table[row, :take], self._scores[row, :take]) if neighbour >= 0]
+
+    def autocomplete(self, prefix: str, take: int) -> dict:
+        """ Packages whose title has a word starting with prefix, plus the nearest neighbours of those packages. """
+        with self._lock:
+            completions = self._complete(normalize_query(prefix), min(take, self.MAX_COMPLETIONS))
+            # Round-robin over the completions' neighbour lists, so each contributes its closest packages first.
+            seen = set(completions)
+            related = []
+            for rank in range(self._table.shape[1]):
+                for row in completions:
+                    neighbour = int(self._table[row, rank])
+                    if neighbour >= 0 and neighbour not in seen and len(related) < take:
+                        seen.add(neighbour)
+                        related.append(neighbour)
+            return {
+                "completions": [{"id": self._ids[row], "metadata": self._metadata[row]} for row in completions],
+                "related": [{"id": self._ids[row], "metadata": self._metadata[row]} for row in related]
+            }
+
+    @staticmethod
+    def _title_suffixes(metadata: dict) -> list[str]:
+        words = normalize_query(metadata.get("Title") or "").split()
+        return [" ".join(words[i:]) for i in range(len(words))]
+
+    def _complete(self, prefix: str, take: int) -> list[int]:
+        if not prefix:
+            return []
+        rows = self._completions.get(prefix[:self.MAX_PREFIX_LENGTH], [])
+        if len(prefix) <= self.MAX_PREFIX_LENGTH:
+            return rows[:take]
+        matches = (row for row in rows
+                   if any(suffix.startswith(prefix) for suffix in self._title_suffixes(self._metadata[row])))
+        return list(islice(matches, take))
+
+    @classmethod
+    def _build_completions(cls, metadata: list[dict], table: np.ndarray) -> dict[str, list[int]]:
+        """ Every title word prefix -> rows, best first. Packages that appear in many neighbour lists rank first. """
+        in_degree = np.bincount(table[table >= 0], minlength=len(metadata))
+        order = sorted(range(len(metadata)),
+                       key=lambda row: (-in_degree[row], (metadata[row].get("Title") or "").lower()))
+        completions: dict[str, list[int]] = {}
+        for row in order:
+            for suffix in cls._title_suffixes(metadata[row]):
+                for length in range(1, min(cls.MAX_PREFIX_LENGTH, len(suffix)) + 1):
+                    rows = completions.setdefault(suffix[:length], [])
+                    # Full-length buckets are kept whole, longer prefixes are answered by filtering them.
+                    if (len(rows) < cls.MAX_COMPLETIONS or length == cls.MAX_PREFIX_LENGTH) \
+                            and (not rows or rows[-1] != row):
+                        rows.append(row)
+        return completions
+
+    def clear(self):
+        with self._refresh_lock:
+            with self._lock:
+                self._pending.clear()
+                self._set_state([], [], np.full((0, self.neighbours), -1, dtype=np.int32),
+                                np.full((0, self.neighbours), -np.inf, dtype=np.float32), None, {})
+            self._save(np.zeros((0, 0), dtype=np.float16))
+
+    def _save(self, vectors: np.ndarray):
+        """ Write the table and its unit vectors to the sidecar as one .npz. """
+        # State is replaced whole by _set_state, so these references stay consistent without holding the lock.
+        with self._lock:
+            ids, metadata, table, scores = self._ids, self._metadata, self._table, self._scores
+        self._sidecar.write(lambda f: np.savez(f, ids=np.array(ids, dtype=str), metadata=np.array(json.dumps(metadata)),
+                                               neighbours=table, scores=scores, vectors=vectors))
+
+    def _read(self, with_vectors: bool = False) -> tuple[list[str], list[dict], np.ndarray, np.ndarray, Optional[np.ndarray]]:
+        # Arrays in an .npz are read on access, so serving workers never load the vectors.
+        with np.load(self.path) as data:
+            return (data["ids"].tolist(), json.loads(data["metadata"].item()), data["neighbours"], data["scores"],
+                    data["vectors"] if with_vectors else None)
+
+    def reload_if_changed(self):
+        """ Load the sidecar if another worker has rewritten it. """
+        self._sidecar.reload_if_changed(self._load)
+
+    def _load(self, path: str):
+        ids, metadata, table, scores, _ = self._read()
+        completions = self._build_completions(metadata, table)
+        with self._lock:
+            self._set_state(ids, metadata, table, scores, None, completions)
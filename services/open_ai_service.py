@@ -1,20 +1,149 @@
-from openai import OpenAI
-from tenacity import retry, stop_after_attempt, wait_exponential
+import asyncio
+from typing import Optional
+import httpx
+from openai import APIStatusError, AsyncOpenAI, OpenAI
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+
+from metrics import OPENAI_TOKENS, UPSTREAM_SECONDS, count_retry
+from utils import embedding_model_key
+
+from .embedding_batcher import EmbeddingBatcher
+from .embedding_cache import EmbeddingCache
+
+def is_transient_error(error: BaseException) -> bool:
+    """ Whether an embeddings call may succeed if retried: not for rejected input such as an over-long text. """
+    if isinstance(error, ValueError):
+        return False
+    if isinstance(error, APIStatusError):
+        return error.status_code >= 500 or error.status_code in (408, 409, 429)
+    return True
+
 
 class OpenAiService:
     embedding_model: str
+    dimensions: Optional[int]
     _openai_client: OpenAI
+    cache: Optional[EmbeddingCache]
+    max_concurrency: int
+    batch_window_seconds: float
+    max_batch_size: int
 
-    def __init__(self, api_key: str, embedding_model: str):
+    def __init__(self,
+                 api_key: str,
+                 embedding_model: str,
+                 cache: Optional[EmbeddingCache] = None,
+                 max_concurrency: int = 16,
+                 batch_window_seconds: float = 0.002,
+                 max_batch_size: int = 256,
+                 base_url: Optional[str] = None,
+                 dimensions: Optional[int] = None):
         self.embedding_model = embedding_model
-        self._openai_client = OpenAI(api_key=api_key)
+        # text-embedding-3 models return a shortened, renormalised embedding when asked for fewer dimensions.
+        self.dimensions = dimensions
+        self._api_key = api_key
+        self._base_url = base_url
+        self._openai_client = OpenAI(api_key=api_key, base_url=base_url)
+        self.cache = cache
+        self.max_concurrency = max_concurrency
+        self.batch_window_seconds = batch_window_seconds
+        self.max_batch_size = max_batch_size
+        self._async_client: Optional[AsyncOpenAI] = None
+        self._async_client_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._async_semaphore: Optional[asyncio.Semaphore] = None
+        self._batcher: Optional[EmbeddingBatcher] = None
+
+    @property
+    def model_key(self) -> str:
+        return embedding_model_key(self.embedding_model, self.dimensions)
+
+    def _embedding_options(self) -> dict:
+        return {"dimensions": self.dimensions} if self.dimensions else {}
+
+    def _get_async_client(self) -> AsyncOpenAI:
+        """ Pooled keep-alive client, recreated if we're called from a different event loop. """
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_client_loop is not loop:
+            self._async_client = AsyncOpenAI(
+                api_key=self._api_key,
+                base_url=self._base_url,
+                http_client=httpx.AsyncClient(
+                    timeout=httpx.Timeout(30.0, connect=10.0),
+                    limits=httpx.Limits(max_connections=self.max_concurrency,
+                                        max_keepalive_connections=self.max_concurrency)
+                )
+            )
+            self._async_semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._batcher = EmbeddingBatcher(self._get_embeddings_with_retry_async,
+                                             self.batch_window_seconds,
+                                             self.max_batch_size,
+                                             split_on_error=lambda error: not is_transient_error(error)) \
+                if self.batch_window_seconds > 0 else None
+            self._async_client_loop = loop
+        return self._async_client
+
+    def warm_up(self):
+        """ Build the pooled async client for the running event loop ahead of the first request. """
+        self._get_async_client()
 
     def get_embedding(self, text: str) -> tuple[list[float], int]:
-        """ Get embedding and tokens used for a text string. """
+        """ Get embedding and tokens used for a text string, served from the cache when possible. """
+        if self.cache is not None:
+            cached = self.cache.get(text, self.model_key)
+            if cached is not None:
+                return (cached, 0)
+
         embeddings, total_tokens = self.get_embeddings([text])
 
+        if self.cache is not None:
+            self.cache.set(text, self.model_key, embeddings[0])
+
         return (embeddings[0], total_tokens)
 
+    async def get_embedding_async(self, text: str) -> tuple[list[float], int]:
+        """ Async get_embedding, for request handlers that shouldn't hold a thread while OpenAI responds.
+        Concurrent calls are coalesced into batched requests unless batch_window_seconds is 0. """
+        if self.cache is not None:
+            cached = await self.cache.get_async(text, self.model_key)
+            if cached is not None:
+                return (cached, 0)
+
+        self._get_async_client()
+        if self._batcher is not None:
+            embedding, total_tokens = await self._batcher.embed(text)
+        else:
+            embeddings, total_tokens = await self._get_embeddings_with_retry_async([text])
+            embedding = embeddings[0]
+
+        if self.cache is not None:
+            await self.cache.set_async(text, self.model_key, embedding)
+
+        return (embedding, total_tokens)
+
+    async def get_query_embeddings_async(self, texts: list[str]) -> tuple[list[list[float]], int]:
+        """ Embed several queries at once: cached ones are served locally, the rest go out in one request. """
+        embeddings: list[Optional[list[float]]] = [None] * len(texts)
+        misses: dict[str, list[int]] = {}
+        for i, text in enumerate(texts):
+            cached = await self.cache.get_async(text, self.model_key) if self.cache is not None else None
+            if cached is not None:
+                embeddings[i] = cached
+            else:
+                misses.setdefault(text, []).append(i)
+
+        total_tokens = 0
+        miss_texts = list(misses)
+        for start in range(0, len(miss_texts), 2048):
+            chunk = miss_texts[start:start+2048]
+            chunk_embeddings, chunk_tokens = await self._get_embeddings_with_retry_async(chunk)
+            total_tokens += chunk_tokens
+            for text, embedding in zip(chunk, chunk_embeddings):
+                for i in misses[text]:
+                    embeddings[i] = embedding
+                if self.cache is not None:
+                    await self.cache.set_async(text, self.model_key, embedding)
+
+        return (embeddings, total_tokens)
+
     def get_embeddings(self, text: list[str]) -> tuple[list[list[float]], int]:
         """ Get embeddings and tokens used for a list of text strings. """
         if len(text) > 2048:
@@ -29,14 +158,36 @@ class OpenAiService:
         else:
             return self._get_embeddings_with_retry(text)
         
-    @retry(stop=stop_after_attempt(4), wait=wait_exponential(multiplier=1, min=1, max=10))
+    @retry(stop=stop_after_attempt(4), wait=wait_exponential(multiplier=1, min=1, max=10), retry=retry_if_exception(is_transient_error),
+           before_sleep=count_retry("openai"))
     def _get_embeddings_with_retry(self, texts: list[str]) -> tuple[list[list[float]], int]:
         """ Get embeddings with exponential retry. """
         if len(texts) > 2048:
             raise ValueError("Text length must be less than or equal to 2048")
         
-        response = self._openai_client.embeddings.create(model=self.embedding_model, input=texts)
+        with UPSTREAM_SECONDS.time(upstream="openai", operation="embeddings"):
+            response = self._openai_client.embeddings.create(model=self.embedding_model, input=texts,
+                                                             **self._embedding_options())
+        total_tokens = response.usage.total_tokens
+        OPENAI_TOKENS.inc(total_tokens)
+        embeddings = [data.embedding for data in response.data]
+
+        return (embeddings, total_tokens)
+
+    @retry(stop=stop_after_attempt(4), wait=wait_exponential(multiplier=1, min=1, max=10), retry=retry_if_exception(is_transient_error),
+           before_sleep=count_retry("openai"))
+    async def _get_embeddings_with_retry_async(self, texts: list[str]) -> tuple[list[list[float]], int]:
+        """ Get embeddings over the pooled async client with exponential retry, at most max_concurrency at once. """
+        if len(texts) > 2048:
+            raise ValueError("Text length must be less than or equal to 2048")
+
+        client = self._get_async_client()
+        async with self._async_semaphore:
+            with UPSTREAM_SECONDS.time(upstream="openai", operation="embeddings"):
+                response = await client.embeddings.create(model=self.embedding_model, input=texts,
+                                                          **self._embedding_options())
         total_tokens = response.usage.total_tokens
+        OPENAI_TOKENS.inc(total_tokens)
         embeddings = [data.embedding for data in response.data]
 
         return (embeddings, total_tokens)
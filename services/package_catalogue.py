@@ -0,0 +1,94 @@
+import json
+import sqlite3
+import threading
+from typing import Iterator, Optional
+
+from utils import to_timestamp
+
+
+class PackageCatalogue:
+    """ Local mirror of the Facepunch package catalogue keyed by FullIdent, backed by SQLite.
+
+    Packages are stored as the JSON Facepunch returned, next to indexed Updated/Created timestamps,
+    so listings are served as indexed reads and can be streamed without decoding every row.
+    A meta row records whether a full crawl has completed, until then the catalogue is only partial.
+    """
+    ORDERS = {
+        "updated": "updated DESC, ident",
+        "created": "created DESC, ident",
+        "ident": "ident"
+    }
+    path: str
+
+    def __init__(self, path: str = ":memory:"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS packages ("
+            "ident TEXT PRIMARY KEY, updated INTEGER NOT NULL, created INTEGER NOT NULL, data TEXT NOT NULL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS packages_updated ON packages (updated DESC, ident)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS packages_created ON packages (created DESC, ident)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM packages").fetchone()[0]
+
+    def is_seeded(self) -> bool:
+        """ Whether a full crawl has been stored, so listings cover the whole catalogue. """
+        with self._lock:
+            return self._connection.execute("SELECT 1 FROM meta WHERE key = 'seeded'").fetchone() is not None
+
+    def seed(self, packages: list[dict]):
+        """ Store a full crawl and mark the catalogue seeded, in one transaction. """
+        with self._lock, self._connection:
+            self._insert(packages)
+            self._connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('seeded', '1')")
+
+    def upsert(self, packages: list[dict]):
+        """ Insert or replace packages as returned by the Facepunch find API. """
+        with self._lock, self._connection:
+            self._insert(packages)
+
+    def _insert(self, packages: list[dict]):
+        rows = [(package["FullIdent"], to_timestamp(package["Updated"]), to_timestamp(package["Created"]),
+                 json.dumps(package)) for package in packages]
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO packages (ident, updated, created, data) VALUES (?, ?, ?, ?)", rows)
+
+    def page(self, order: str, take: int, skip: int = 0) -> list[dict]:
+        """ A page of packages, newest first for the updated and created orders. """
+        return [json.loads(data) for data in self._page_json(order, take, skip)]
+
+    def _page_json(self, order: str, take: int, skip: int) -> list[str]:
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT data FROM packages ORDER BY {self.ORDERS[order]} LIMIT ? OFFSET ?", (take, skip))
+            return [data for (data,) in rows]
+
+    def iter_json(self, chunk_size: int = 1000) -> Iterator[str]:
+        """ Every package as a JSON array, yielded in chunks so the whole catalogue is never held at once. """
+        yield "["
+        last_ident: Optional[str] = None
+        first = True
+        while True:
+            # Keyset paging: each chunk is an indexed range scan and the lock is only held per chunk.
+            with self._lock:
+                rows = self._connection.execute(
+                    "SELECT ident, data FROM packages WHERE ident > ? ORDER BY ident LIMIT ?",
+                    (last_ident or "", chunk_size)).fetchall()
+            if not rows:
+                break
+            chunk = ",".join(data for _, data in rows)
+            yield chunk if first else "," + chunk
+            first = False
+            last_ident = rows[-1][0]
+        yield "]"
+
+    def clear(self):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM packages")
+            self._connection.execute("DELETE FROM meta WHERE key = 'seeded'")
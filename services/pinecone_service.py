@@ -1,144 +1,271 @@
-from datetime import datetime
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Iterator, Optional
 from pinecone import Pinecone
 from tenacity import retry, stop_after_attempt, wait_exponential
 
+from metrics import UPSTREAM_SECONDS, count_retry
 from models import PineconeVector
+from .timestamp_index import TimestampIndex
 
 class PineconeService:
+    # Pinecone rejects upsert requests over 2MB or 1000 vectors.
+    MAX_UPSERT_BYTES = 2_000_000
+    MAX_UPSERT_VECTORS = 1000
+    # Pinecone's published limits (e.g. 245 vectors of 1536 dimensions per request) work out to ~6 bytes a value.
+    BYTES_PER_VALUE = 6
+    # Pinecone returns at most 1000 matches with metadata, and seeding stops once a window holds half that.
+    SEED_QUERY_SIZE = 1000
+    SEED_QUERIES = 24
     _pinecone: Pinecone
+    _timestamp_index: TimestampIndex
+    max_concurrency: int
+    upsert_concurrency: int
+    index_version: int
 
-    def __init__(self, api_key: str, index_name: str):
-        self._pinecone = Pinecone(api_key=api_key)
-        self._index = self._pinecone.Index(index_name)
+    def __init__(self,
+                 api_key: str,
+                 index_name: str,
+                 timestamp_index: Optional[TimestampIndex] = None,
+                 max_concurrency: int = 16,
+                 index=None,
+                 upsert_concurrency: int = 8):
+        # An index object with the same data-plane surface can be passed in instead, e.g. a local stand-in.
+        if index is None:
+            self._pinecone = Pinecone(api_key=api_key)
+            index = self._pinecone.Index(index_name)
+        self._index = index
+        self._timestamp_index = timestamp_index or TimestampIndex()
+        self._rebuild_lock = threading.Lock()
+        self._dimension: Optional[int] = None
+        self.max_concurrency = max_concurrency
+        # Bumped on every write made through this service, so cached search results can tell they're stale.
+        self.index_version = 0
+        # Queries from async handlers run here, so Pinecone gets its own bounded pool instead of FastAPI's.
+        self._query_executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="pinecone-query")
+        self.upsert_concurrency = upsert_concurrency
+        self._upsert_executor = ThreadPoolExecutor(max_workers=upsert_concurrency, thread_name_prefix="pinecone-upsert")
 
-    def upsert_embeddings(self, data: list[PineconeVector]):
-        """ Upsert embeddings to the Pinecone index. """
-        for i in range(0, len(data), 100):
-            self._index.upsert(vectors=[vector.to_dict() for vector in data[i:i+100]])
+    def warm_up(self):
+        """ Open the connection to the index now, so the first search doesn't pay for the handshake. """
+        with UPSTREAM_SECONDS.time(upstream="pinecone", operation="describe"):
+            self._index.describe_index_stats()
 
+    def save(self):
+        """ Persist the timestamp index; the vectors themselves are stored by Pinecone. """
+        self._timestamp_index.save()
 
-    @retry(stop=stop_after_attempt(4), wait=wait_exponential(multiplier=1, min=1, max=10))
+    def upsert_embeddings(self,
+                          data: list[PineconeVector],
+                          on_batch: Optional[Callable[[list[PineconeVector]], None]] = None):
+        """ Upsert embeddings to the Pinecone index in parallel batches, each retried on its own.
+
+        on_batch is called with each batch once Pinecone has acknowledged it. Upserts are idempotent by id,
+        so a caller that records acknowledged batches can resume after a failure by skipping them.
+        """
+        batches = self._upsert_batches(data)
+        futures = {self._upsert_executor.submit(self._upsert_with_retry, payload): vectors
+                   for vectors, payload in batches}
+        first_error = None
+        try:
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                if future.exception() is not None:
+                    # Stop starting new batches, but let those in flight finish so they're still acknowledged.
+                    if first_error is None:
+                        first_error = future.exception()
+                        for other in futures:
+                            other.cancel()
+                    continue
+                self._timestamp_index.update(futures[future], persist=False)
+                if on_batch is not None:
+                    on_batch(futures[future])
+            if first_error is not None:
+                raise first_error
+        finally:
+            if batches:
+                self._timestamp_index.save()
+                self.index_version += 1
+
+    def _upsert_batches(self, data: list[PineconeVector]) -> list[tuple[list[PineconeVector], list[dict]]]:
+        """ Split vectors into request-sized batches by estimated payload bytes, converting each vector once. """
+        batches = []
+        vectors, payload, size = [], [], 0
+        for vector in data:
+            item = vector.to_dict()
+            item_size = self.BYTES_PER_VALUE * len(vector.values) + len(json.dumps(vector.metadata)) + len(vector.id) + 64
+            if payload and (size + item_size > self.MAX_UPSERT_BYTES or len(payload) == self.MAX_UPSERT_VECTORS):
+                batches.append((vectors, payload))
+                vectors, payload, size = [], [], 0
+            vectors.append(vector)
+            payload.append(item)
+            size += item_size
+        if payload:
+            batches.append((vectors, payload))
+        return batches
+
+    @retry(stop=stop_after_attempt(4), wait=wait_exponential(multiplier=1, min=1, max=10), before_sleep=count_retry("pinecone"))
+    def _upsert_with_retry(self, payload: list[dict]):
+        """ Upsert one batch with retry. """
+        with UPSTREAM_SECONDS.time(upstream="pinecone", operation="upsert"):
+            self._index.upsert(vectors=payload)
+
+
+    def update_metadata(self, data: list[PineconeVector]):
+        """ Replace the metadata of existing vectors without re-sending their values. """
+        # One request per vector, so they share the bounded upsert pool.
+        list(self._upsert_executor.map(lambda vector: self._update_metadata_with_retry(vector.id, vector.metadata), data))
+        self._timestamp_index.update(data)
+        self.index_version += 1
+
+    @retry(stop=stop_after_attempt(4), wait=wait_exponential(multiplier=1, min=1, max=10), before_sleep=count_retry("pinecone"))
+    def _update_metadata_with_retry(self, id: str, metadata: dict):
+        """ Update a single vector's metadata with retry. """
+        with UPSTREAM_SECONDS.time(upstream="pinecone", operation="update"):
+            self._index.update(id=id, set_metadata=metadata)
+
+    def iter_vectors(self, batch_size: int = 100) -> Iterator[list[PineconeVector]]:
+        """ Page through every vector in the index, values included. Listing ids needs a serverless index. """
+        pages = self._index.list()
+        while True:
+            try:
+                ids = next(pages)
+            except StopIteration:
+                return
+            except Exception as e:
+                raise RuntimeError("Listing vector ids failed; seeding the lexical and neighbour indexes "
+                                   "from Pinecone needs a serverless index") from e
+            for i in range(0, len(ids), batch_size):
+                yield self._fetch_with_retry(ids[i:i+batch_size])
+
+    @retry(stop=stop_after_attempt(4), wait=wait_exponential(multiplier=1, min=1, max=10), before_sleep=count_retry("pinecone"))
+    def _fetch_with_retry(self, ids: list[str]) -> list[PineconeVector]:
+        """ Fetch vectors by id with retry. """
+        with UPSTREAM_SECONDS.time(upstream="pinecone", operation="fetch"):
+            response = self._index.fetch(ids=ids)
+        return [PineconeVector(
+            id=vector.id,
+            values=vector.values,
+            metadata=vector.metadata
+        ) for vector in response.vectors.values()]
+
+    @retry(stop=stop_after_attempt(4), wait=wait_exponential(multiplier=1, min=1, max=10), before_sleep=count_retry("pinecone"))
     def _search_pinecone_with_retry(self, 
                                    embedding: list[float], 
                                    take: int, 
                                    skip: int, 
-                                   filter_dict: dict) -> list[PineconeVector]:
+                                   filter_dict: dict) -> list[dict]:
         """ Semantic Search the Pinecone index with retry. """
         topk = take + skip
-        response = self._index.query(
-            vector=embedding,
-            top_k=topk,
-            include_values=True,
-            include_metadata=True,
-            filter=filter_dict
-        )
+        # Search callers only use ids and metadata, vector values would multiply the payload for nothing.
+        with UPSTREAM_SECONDS.time(upstream="pinecone", operation="query"):
+            response = self._index.query(
+                vector=embedding,
+                top_k=topk,
+                include_values=False,
+                include_metadata=True,
+                filter=filter_dict
+            )
         
-        return [PineconeVector(
-            id=result["id"],
-            values=result["values"],
-            metadata=result["metadata"]
-        ) for result in response["matches"][skip:take+skip]]
+        return [{
+            "id": result["id"],
+            "metadata": result["metadata"]
+        } for result in response["matches"][skip:take+skip]]
 
 
     def search_pinecone(self, 
                         embedding: list[float], 
                         take: int, 
                         skip: int, 
-                        filter_dict: dict) -> list[PineconeVector]:
-        """ Semantic Search the Pinecone index """
+                        filter_dict: dict) -> list[dict]:
+        """ Semantic Search the Pinecone index, returning {"id", "metadata"} matches in rank order. """
         try:
             return self._search_pinecone_with_retry(embedding, take, skip, filter_dict)
         except Exception as e:
             print("Error searching Pinecone index.\nError:", e)
             raise e
+
+    async def search_pinecone_async(self,
+                                    embedding: list[float],
+                                    take: int,
+                                    skip: int,
+                                    filter_dict: dict) -> list[dict]:
+        """ search_pinecone on the bounded query pool, awaitable from the event loop. """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._query_executor, self.search_pinecone, embedding, take, skip, filter_dict)
     
-    def fetch_packages_created_after(self, take: int, date: int) -> list[PineconeVector]:
-        """ Fetch packages from Pinecone index ordered by date updated. """
-        # fetch all and sort in code
-        vector = []
-        for i in range(1536):
-            vector.append(0.0)
-
-        response = self._index.query(
-            vector=vector,
-            top_k=take,
-            include_values=False,
-            include_metadata=True,
-            filter={"Created": {"$gte": date}},
-        )
-
-        matches = response["matches"]
-        matches.sort(key=lambda x: x["metadata"]["Created"], reverse=True)
-
-        return matches
-    
-    def fetch_packages_updated_after(self, take: int, date: int) -> list[PineconeVector]:
-        """ Fetch packages from Pinecone index ordered by date updated. """
-        vector = []
-        for i in range(1536):
-            vector.append(0.0)
-
-        response = self._index.query(
-            vector=vector,
-            top_k=take,
-            include_values=False,
-            include_metadata=True,
-            filter={"Updated": {"$gte": date}},
-        )
-
-        matches = response["matches"]
-        matches.sort(key=lambda x: x["metadata"]["Updated"], reverse=True)
-
-        return matches
-    
+    def seed_timestamp_index(self):
+        """ Seed the timestamp index with the newest packages by Updated and by Created.
+
+        Uses filtered metadata queries, so it works on any index type and never fetches vector values.
+        Everything upserted afterwards is recorded, so newest lookups stay exact for the seeded window.
+        """
+        self._timestamp_index.replace([self._query_newest("Updated"), self._query_newest("Created")])
+        print(f"Seeded timestamp index with {len(self._timestamp_index)} packages")
+
+    def _query_newest(self, field: str) -> list[PineconeVector]:
+        """ Every package with field at or after the latest cutoff whose matches fit in one query.
+
+        The cutoff steps back in doubling windows until a query returns fewer than SEED_QUERY_SIZE matches,
+        then bisects back towards the newest cutoff that overflowed, since an overflowing query is arbitrary.
+        """
+        now = int(time.time())
+        offset = 12 * 3600
+        complete: list[PineconeVector] = []
+        complete_since, overflow_since = now + 1, None
+        for _ in range(self.SEED_QUERIES):
+            if overflow_since is None:
+                since = now - offset
+                offset *= 2
+            else:
+                since = (complete_since + overflow_since) // 2
+                if since in (complete_since, overflow_since):
+                    break
+            matches = self._query_metadata_with_retry({field: {"$gte": since}}, self.SEED_QUERY_SIZE)
+            if len(matches) >= self.SEED_QUERY_SIZE:
+                overflow_since = since
+                continue
+            complete_since, complete = since, matches
+            if len(matches) >= self.SEED_QUERY_SIZE // 2 or since <= 0:
+                break
+        return complete
+
+    @retry(stop=stop_after_attempt(4), wait=wait_exponential(multiplier=1, min=1, max=10), before_sleep=count_retry("pinecone"))
+    def _query_metadata_with_retry(self, filter_dict: dict, top_k: int) -> list[PineconeVector]:
+        """ Up to top_k vectors matching filter_dict, metadata only. The zero query vector ranks nothing. """
+        if self._dimension is None:
+            self._dimension = int(self._index.describe_index_stats()["dimension"])
+        with UPSTREAM_SECONDS.time(upstream="pinecone", operation="query"):
+            response = self._index.query(
+                vector=[0.0] * self._dimension,
+                top_k=top_k,
+                include_values=False,
+                include_metadata=True,
+                filter=filter_dict
+            )
+        return [PineconeVector(id=match["id"], values=[], metadata=match["metadata"]) for match in response["matches"]]
+
+    def _fetch_recent(self, field: str, take: int) -> list[PineconeVector]:
+        # Updated and created lookups run together, only one of them should seed the index. The seed
+        # swaps in a complete index, so the unlocked check never sees a half built one.
+        if len(self._timestamp_index) == 0:
+            with self._rebuild_lock:
+                if len(self._timestamp_index) == 0:
+                    self.seed_timestamp_index()
+        return self._timestamp_index.newest(field, take)
+
     def fetch_recently_created_packages(self, take: int) -> list[PineconeVector]:
-        # We need to ensure we get back less than we asked for otherwise we cant guarantee the order
-        date = int(datetime.now().timestamp())
-        offset = 3600 * 12
-        fetch_amount = max(take*2, 20)
-        packages = []
-        iterations = 0
-        while len(packages) <= take and iterations < 10:
-            packages = self.fetch_packages_created_after(fetch_amount, date - offset*iterations)
-            offset *= 2
-            iterations += 1
-
-        iterations_2 = 0
-        while len(packages) == fetch_amount and iterations_2 < 10:
-            fetch_amount *= 2
-            iterations_2 += 1
-            packages = self.fetch_packages_created_after(fetch_amount, date - offset*iterations)
-        
-        print(f"Found {len(packages)} packages while searching for {fetch_amount} packages")
-        print(f"It took {iterations + iterations_2} iterations to find {take} packages")
-        
-        return packages[:take]
-    
+        return self._fetch_recent("Created", take)
+
     def fetch_recently_updated_packages(self, take: int) -> list[PineconeVector]:
-        # We need to ensure we get back less than we asked for otherwise we cant guarantee the order
-        date = int(datetime.now().timestamp())
-        offset = 3600 * 12
-        fetch_amount = max(take*2, 20)
-        packages = []
-        iterations = 0
-        while len(packages) <= take and iterations < 10:
-            packages = self.fetch_packages_updated_after(fetch_amount, date - offset*iterations)
-            offset *= 2
-            iterations += 1
-
-        iterations_2 = 0
-        while len(packages) == fetch_amount and iterations_2 < 10:
-            fetch_amount *= 2
-            iterations_2 += 1
-            packages = self.fetch_packages_updated_after(fetch_amount, date - offset*iterations)
-        
-        print(f"Found {len(packages)} packages while searching for {fetch_amount} packages")
-        print(f"It took {iterations + iterations_2} iterations to find {take} packages")
-        
-        return packages[:take]
-        
+        return self._fetch_recent("Updated", take)
 
-    
     def delete_index(self):
         """ Delete the Pinecone index """
-        self._index.delete(delete_all=True)
\ No newline at end of file
+        self._index.delete(delete_all=True)
+        self._timestamp_index.clear()
+        self.index_version += 1
\ No newline at end of file
@@ -0,0 +1,156 @@
+from typing import Optional
+
+import numpy as np
+
+# Rows a quantizer is fitted on; scales and centroids settle long before the whole corpus is seen.
+FIT_SAMPLE_ROWS = 20000
+# Rows scored per block, so the float32 copy of a block of codes stays in cache (1.5 MB at 1536 dimensions).
+SCORE_BLOCK_ROWS = 256
+
+
+class Int8Quantizer:
+    """ Scalar quantization of each dimension to int8, with scales fitted to the corpus.
+
+    Scoring is asymmetric: the float query is pre-multiplied by the scales and dotted with the raw codes,
+    so stored vectors are never decoded. A quarter of the float32 size.
+    """
+    kind = "int8"
+    scales: Optional[np.ndarray]
+
+    def __init__(self, scales: Optional[np.ndarray] = None):
+        self.scales = None if scales is None else np.asarray(scales, dtype=np.float32)
+
+    @property
+    def code_size(self) -> int:
+        return len(self.scales)
+
+    @property
+    def params(self) -> Optional[np.ndarray]:
+        return self.scales
+
+    def fit(self, vectors: np.ndarray, seed: int = 0) -> "Int8Quantizer":
+        # A high quantile instead of the max keeps one outlier from costing every other row its precision.
+        bounds = np.quantile(np.abs(np.asarray(vectors, dtype=np.float32)), 0.999, axis=0)
+        self.scales = (np.maximum(bounds, 1e-6) / 127).astype(np.float32)
+        return self
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        codes = np.rint(np.asarray(vectors, dtype=np.float32) / self.scales)
+        return np.clip(codes, -127, 127).astype(np.int8)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return codes.astype(np.float32) * self.scales
+
+    def scores(self, query: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        scaled_query = (np.asarray(query, dtype=np.float32) * self.scales).astype(np.float32)
+        scores = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), SCORE_BLOCK_ROWS):
+            block = codes[start:start+SCORE_BLOCK_ROWS]
+            scores[start:start+len(block)] = block.astype(np.float32) @ scaled_query
+        return scores
+
+
+class ProductQuantizer:
+    """ Product quantization: each of `subspaces` slices of a vector is replaced by the id of its nearest
+    of 256 k-means centroids, one byte per slice.
+
+    Scoring builds a (subspaces x 256) table of query/centroid dot products once per query and sums table
+    lookups per row. For 1536 dimensions and 96 subspaces that is 96 bytes per vector, 64x smaller than float32.
+    """
+    kind = "pq"
+    subspaces: int
+    centroids: Optional[np.ndarray]
+
+    def __init__(self, subspaces: int = 96, centroids: Optional[np.ndarray] = None):
+        self.subspaces = subspaces
+        self.centroids = None if centroids is None else np.asarray(centroids, dtype=np.float32)
+
+    @property
+    def code_size(self) -> int:
+        return self.subspaces
+
+    @property
+    def params(self) -> Optional[np.ndarray]:
+        return self.centroids
+
+    def _split(self, vectors: np.ndarray) -> np.ndarray:
+        """ (n, dimension) -> (subspaces, n, dimension / subspaces) """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.shape[1] % self.subspaces:
+            raise ValueError(f"Dimension {vectors.shape[1]} is not divisible into {self.subspaces} subspaces")
+        return vectors.reshape(len(vectors), self.subspaces, -1).transpose(1, 0, 2)
+
+    def fit(self, vectors: np.ndarray, seed: int = 0, iterations: int = 12) -> "ProductQuantizer":
+        dimension = np.shape(vectors)[1]
+        # Shortened embeddings may not split evenly, so fall back to the largest subspace count that does.
+        self.subspaces = max(count for count in range(1, self.subspaces + 1) if dimension % count == 0)
+        rng = np.random.default_rng(seed)
+        parts = self._split(vectors)
+        clusters = min(256, len(vectors))
+        centroids = np.empty((self.subspaces, clusters, parts.shape[2]), dtype=np.float32)
+        for j, part in enumerate(parts):
+            centers = part[rng.choice(len(part), clusters, replace=False)].copy()
+            for _ in range(iterations):
+                assignment = self._nearest(part, centers)
+                sums = np.zeros_like(centers)
+                np.add.at(sums, assignment, part)
+                counts = np.bincount(assignment, minlength=clusters)
+                occupied = counts > 0
+                centers[occupied] = sums[occupied] / counts[occupied, None]
+            centroids[j] = centers
+        self.centroids = centroids
+        return self
+
+    @staticmethod
+    def _nearest(part: np.ndarray, centers: np.ndarray) -> np.ndarray:
+        # argmin ||x - c||^2 == argmin ||c||^2 - 2 x.c
+        distances = (centers * centers).sum(axis=1) - 2 * part @ centers.T
+        return distances.argmin(axis=1)
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        parts = self._split(vectors)
+        codes = np.empty((parts.shape[1], self.subspaces), dtype=np.uint8)
+        for j, part in enumerate(parts):
+            codes[:, j] = self._nearest(part, self.centroids[j])
+        return codes
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        parts = [self.centroids[j][codes[:, j]] for j in range(self.subspaces)]
+        return np.concatenate(parts, axis=1)
+
+    def scores(self, query: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        query_parts = np.asarray(query, dtype=np.float32).reshape(self.subspaces, -1)
+        table = np.einsum("jcd,jd->jc", self.centroids, query_parts).astype(np.float32)
+        # Offsetting each subspace's codes into the flattened table turns the lookups into one gather.
+        flat_table = table.ravel()
+        offsets = np.arange(self.subspaces, dtype=np.int64) * table.shape[1]
+        scores = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), SCORE_BLOCK_ROWS):
+            block = codes[start:start+SCORE_BLOCK_ROWS]
+            scores[start:start+len(block)] = flat_table[block + offsets].sum(axis=1)
+        return scores
+
+
+def create_quantizer(kind: str) -> Int8Quantizer | ProductQuantizer:
+    if kind == "int8":
+        return Int8Quantizer()
+    if kind == "pq":
+        return ProductQuantizer()
+    raise ValueError(f"Unknown quantization {kind}, expected int8 or pq")
+
+
+def load_quantizer(kind: str, params: np.ndarray) -> Int8Quantizer | ProductQuantizer:
+    """ Rebuild a fitted quantizer from its kind and params array, as stored in a vector snapshot. """
+    if kind == "int8":
+        return Int8Quantizer(scales=params)
+    if kind == "pq":
+        return ProductQuantizer(subspaces=params.shape[0], centroids=params)
+    raise ValueError(f"Unknown quantization {kind}")
+
+
+def fit_sample(vectors: np.ndarray, seed: int = 0) -> np.ndarray:
+    """ Up to FIT_SAMPLE_ROWS rows of vectors drawn without replacement, as float32. """
+    if len(vectors) <= FIT_SAMPLE_ROWS:
+        return np.asarray(vectors, dtype=np.float32)
+    rows = np.sort(np.random.default_rng(seed).choice(len(vectors), FIT_SAMPLE_ROWS, replace=False))
+    return np.asarray(vectors[rows], dtype=np.float32)
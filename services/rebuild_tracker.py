@@ -0,0 +1,65 @@
+import json
+import os
+from typing import Optional
+
+from .shared_cache import SharedCache
+
+
+class RebuildTracker:
+    """ Which worker is running a full rebuild and how far it has got.
+
+    With a SharedCache the claim and the progress report live in its SQLite file, so every worker refuses a
+    second rebuild and any of them can answer a progress request. The claim is a lease the running worker
+    renews each time it publishes progress, so a worker that dies mid-rebuild doesn't block the next one.
+    Without a SharedCache the state is kept in this process.
+    """
+    LEASE_KEY = "index:rebuild:lease"
+    PROGRESS_KEY = "index:rebuild:progress"
+    lease_seconds: float
+    progress_ttl_seconds: float
+
+    def __init__(self,
+                 shared: Optional[SharedCache] = None,
+                 lease_seconds: float = 30.0,
+                 progress_ttl_seconds: float = 7 * 24 * 3600):
+        self.lease_seconds = lease_seconds
+        self.progress_ttl_seconds = progress_ttl_seconds
+        self._shared = shared
+        self._running = False
+        self._progress: Optional[dict] = None
+
+    def claim(self) -> bool:
+        """ Take the rebuild for this worker, False if one is already running anywhere. """
+        if self._shared is None:
+            if self._running:
+                return False
+            self._running = True
+            return True
+        return self._shared.claim(self.LEASE_KEY, str(os.getpid()).encode(), self.lease_seconds)
+
+    def publish(self, progress: dict):
+        """ Report progress and, while the rebuild is running, renew the lease. """
+        self._progress = progress
+        if self._shared is None:
+            return
+        self._shared.set(self.PROGRESS_KEY, json.dumps(progress).encode(), self.progress_ttl_seconds)
+        if progress["running"]:
+            self._shared.set(self.LEASE_KEY, str(os.getpid()).encode(), self.lease_seconds)
+
+    def release(self):
+        self._running = False
+        if self._shared is not None:
+            self._shared.delete(self.LEASE_KEY)
+
+    def progress(self) -> Optional[dict]:
+        """ The last progress published by whichever worker ran the most recent rebuild. """
+        if self._shared is None:
+            return self._progress
+        value = self._shared.get(self.PROGRESS_KEY)
+        if value is None:
+            return None
+        progress = json.loads(value)
+        if progress["running"] and self._shared.get(self.LEASE_KEY) is None:
+            # The lease lapsed without a final report, so the worker running it stopped.
+            progress.update(running=False, error=progress["error"] or "The worker running the rebuild stopped")
+        return progress
@@ -0,0 +1,160 @@
+import asyncio
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from utils import normalize_query
+from .shared_cache import SharedCache
+
+
+class SearchResultCache:
+    """ Bounded LRU + TTL cache of ranked search results per (query, type filter).
+
+    Each entry holds the top `depth` matches once, so any skip/take page within it is a slice. Entries
+    remember the index version they were computed against and are dropped once the index has changed.
+    With a shared cache, rankings are also shared between worker processes, and invalidate() drops them for all.
+    """
+    GENERATION = "search_results"
+    max_entries: int
+    ttl_seconds: float
+    depth: int
+    shared: Optional[SharedCache]
+
+    def __init__(self,
+                 max_entries: int = 5_000,
+                 ttl_seconds: float = 3600,
+                 depth: int = 100,
+                 shared: Optional[SharedCache] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.depth = depth
+        self.shared = shared
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple, tuple[float, tuple[int, int], list[dict], bool]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(query: str, model: str, type_filter: list[str]) -> tuple:
+        return (model, normalize_query(query), tuple(sorted(set(type_filter))))
+
+    @staticmethod
+    def _shared_key(key: tuple, generation: int) -> str:
+        return "\x00".join(("results", str(generation), key[0], key[1], ",".join(key[2])))
+
+    def _generation(self) -> int:
+        return self.shared.generation(self.GENERATION) if self.shared is not None else 0
+
+    def get(self,
+            query: str,
+            model: str,
+            type_filter: list[str],
+            index_version: int,
+            take: int,
+            skip: int) -> Optional[list[dict]]:
+        """ The requested page, or None if it isn't cached for the current index version. """
+        key = self.make_key(query, model, type_filter)
+        version = (index_version, self._generation())
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] < time.time() or entry[1] != version):
+                del self._entries[key]
+                entry = None
+            if entry is not None and self._covers(entry, take, skip):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2][skip:skip+take]
+
+        value = self.shared.get(self._shared_key(key, version[1])) if self.shared is not None else None
+        with self._lock:
+            if value is not None:
+                # Computed by another worker against the same shared generation.
+                entry = self._store(key, version, *pickle.loads(value))
+                if self._covers(entry, take, skip):
+                    self.shared_hits += 1
+                    return entry[2][skip:skip+take]
+            self.misses += 1
+            return None
+
+    async def get_async(self,
+                        query: str,
+                        model: str,
+                        type_filter: list[str],
+                        index_version: int,
+                        take: int,
+                        skip: int) -> Optional[list[dict]]:
+        """ get, in a worker thread when a lookup may wait on the shared cache's file lock. """
+        if self.shared is None:
+            return self.get(query, model, type_filter, index_version, take, skip)
+        return await asyncio.to_thread(self.get, query, model, type_filter, index_version, take, skip)
+
+    @staticmethod
+    def _covers(entry: tuple, take: int, skip: int) -> bool:
+        # A ranking shorter than depth is every match there is, so pages past its end are just empty.
+        return len(entry[2]) >= take + skip or entry[3]
+
+    def set(self,
+            query: str,
+            model: str,
+            type_filter: list[str],
+            index_version: int,
+            results: list[dict],
+            requested: int):
+        """ Store a ranking fetched with top_k=requested. """
+        key = self.make_key(query, model, type_filter)
+        version = (index_version, self._generation())
+        complete = len(results) < requested
+        with self._lock:
+            self._store(key, version, results, complete)
+        if self.shared is not None:
+            self.shared.set(self._shared_key(key, version[1]),
+                            pickle.dumps((results, complete), protocol=pickle.HIGHEST_PROTOCOL), self.ttl_seconds)
+
+    async def set_async(self,
+                        query: str,
+                        model: str,
+                        type_filter: list[str],
+                        index_version: int,
+                        results: list[dict],
+                        requested: int):
+        if self.shared is None:
+            return self.set(query, model, type_filter, index_version, results, requested)
+        await asyncio.to_thread(self.set, query, model, type_filter, index_version, results, requested)
+
+    def _store(self, key: tuple, version: tuple[int, int], results: list[dict], complete: bool) -> tuple:
+        entry = self._entries[key] = (time.time() + self.ttl_seconds, version, results, complete)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self):
+        """ Drop every cached ranking, in this process and, through the shared generation, in every other. """
+        if self.shared is not None:
+            self.shared.bump(self.GENERATION)
+        with self._lock:
+            self._entries.clear()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.shared_hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "depth": self.depth,
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "hit_ratio": (self.hits + self.shared_hits) / lookups if lookups else 0.0
+            }
@@ -0,0 +1,134 @@
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+
+class SharedCache:
+    """ Expiring key/value cache in a SQLite file that every worker process on the host opens.
+
+    It sits behind the in-process caches as a second tier, so a miss in one worker can be served by another
+    worker's work. Named generation counters let one worker invalidate entries for all of them. Entries are
+    bounded by count and by max_bytes of values, so the file stays within its filesystem (e.g. a tmpfs).
+
+    get and set are best effort: if the file is locked for too long or its disk is full, a read is a miss
+    and a write is dropped, and callers carry on with their in-process caches.
+    """
+    PRUNE_EVERY = 1000
+    path: str
+    max_entries: int
+    max_bytes: int
+
+    def __init__(self, path: str, max_entries: int = 100_000, max_bytes: int = 32 * 1024 * 1024):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._writes = 0
+        self._written_bytes = 0
+        self._generations: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=5.0)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        # A cache can lose its last writes on power loss, so skip fsync entirely.
+        self._connection.execute("PRAGMA synchronous=OFF")
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, expires_at REAL NOT NULL, value BLOB NOT NULL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS entries_expires_at ON entries (expires_at)")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS generations (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            with self._lock:
+                row = self._connection.execute(
+                    "SELECT value FROM entries WHERE key = ? AND expires_at >= ?", (key, time.time())).fetchone()
+        except sqlite3.Error as e:
+            print("Error reading from the shared cache.\nError:", e)
+            return None
+        return row[0] if row else None
+
+    def set(self, key: str, value: bytes, ttl_seconds: float):
+        try:
+            with self._lock, self._connection:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO entries (key, expires_at, value) VALUES (?, ?, ?)",
+                    (key, time.time() + ttl_seconds, value))
+                self._writes += 1
+                self._written_bytes += len(value)
+                # Large values fill the byte budget long before PRUNE_EVERY writes.
+                if self._writes % self.PRUNE_EVERY == 0 or self._written_bytes >= self.max_bytes // 10:
+                    self._prune()
+        except sqlite3.Error as e:
+            print("Error writing to the shared cache.\nError:", e)
+            # The filesystem is smaller than max_bytes allows for, so make room by halving the cache.
+            if isinstance(e, sqlite3.OperationalError) and "full" in str(e):
+                self._prune_after_error()
+
+    def claim(self, key: str, value: bytes, ttl_seconds: float) -> bool:
+        """ Set key only if it's missing or expired, so exactly one process sharing the file wins it. """
+        now = time.time()
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                "INSERT INTO entries (key, expires_at, value) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET expires_at = excluded.expires_at, value = excluded.value "
+                "WHERE entries.expires_at < ?", (key, now + ttl_seconds, value, now))
+            return cursor.rowcount > 0
+
+    def delete(self, key: str):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def _prune(self, max_bytes: Optional[int] = None):
+        """ Drop expired entries, then the soonest to expire beyond max_entries or max_bytes. """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        self._written_bytes = 0
+        self._connection.execute("DELETE FROM entries WHERE expires_at < ?", (time.time(),))
+        count, size = self._connection.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM entries").fetchone()
+        if count > self.max_entries:
+            self._connection.execute(
+                "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY expires_at LIMIT ?)",
+                (count - self.max_entries,))
+            size = self._connection.execute("SELECT COALESCE(SUM(LENGTH(value)), 0) FROM entries").fetchone()[0]
+        if size > max_bytes:
+            # Keep a tenth of headroom, so the next prune isn't due after a handful of writes.
+            excess = size - max_bytes * 9 // 10
+            self._connection.execute(
+                "DELETE FROM entries WHERE key IN (SELECT key FROM ("
+                "SELECT key, SUM(LENGTH(value)) OVER (ORDER BY expires_at, key) - LENGTH(value) AS freed FROM entries"
+                ") WHERE freed < ?)", (excess,))
+
+    def _prune_after_error(self):
+        try:
+            with self._lock, self._connection:
+                size = self._connection.execute("SELECT COALESCE(SUM(LENGTH(value)), 0) FROM entries").fetchone()[0]
+                self._prune(min(self.max_bytes, size // 2))
+        except sqlite3.Error as e:
+            print("Error pruning the shared cache.\nError:", e)
+
+    def generation(self, name: str) -> int:
+        """ The counter's current value, or the last one read here if the file can't be read. """
+        try:
+            with self._lock:
+                row = self._connection.execute("SELECT value FROM generations WHERE name = ?", (name,)).fetchone()
+        except sqlite3.Error as e:
+            print("Error reading from the shared cache.\nError:", e)
+            return self._generations.get(name, 0)
+        self._generations[name] = row[0] if row else 0
+        return self._generations[name]
+
+    def bump(self, name: str) -> int:
+        """ Advance a generation counter for every process sharing the file. """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO generations (name, value) VALUES (?, 1) "
+                "ON CONFLICT (name) DO UPDATE SET value = value + 1", (name,))
+            return self._connection.execute("SELECT value FROM generations WHERE name = ?", (name,)).fetchone()[0]
+
+    def clear(self):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM entries")
@@ -0,0 +1,68 @@
+import fcntl
+import os
+import threading
+from contextlib import contextmanager
+from typing import IO, Callable, Iterator, Optional
+
+
+class Sidecar:
+    """ A local file that one process rewrites whole and the other worker processes reload when it changes.
+
+    Writes go to a per-process temp file that is swapped in with os.replace, so readers never see a
+    partial file. The mtime of the last load or write is remembered, so an unchanged file is one stat.
+    """
+    path: Optional[str]
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self._loaded_mtime: Optional[int] = None
+        self._reload_lock = threading.Lock()
+
+    def write(self, write: Callable[[IO], None], mode: str = "wb"):
+        """ Atomically replace the file with whatever write(file) writes. """
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp.{os.getpid()}"
+        with open(tmp_path, mode) as f:
+            write(f)
+        os.replace(tmp_path, self.path)
+        self.mark_loaded()
+
+    def mark_loaded(self):
+        """ Record the file as current, e.g. after a writer that does its own atomic replace. """
+        self._loaded_mtime = self._mtime()
+
+    def reload_if_changed(self, load: Callable[[str], None]) -> bool:
+        """ Call load(path) if the file has been rewritten since it was last loaded or written here. """
+        mtime = self._mtime()
+        if mtime is None or mtime == self._loaded_mtime:
+            return False
+        # One thread reloads, the others wait for it rather than parsing the same file again.
+        with self._reload_lock:
+            mtime = self._mtime()
+            if mtime is None or mtime == self._loaded_mtime:
+                return False
+            load(self.path)
+            self._loaded_mtime = mtime
+        return True
+
+    @contextmanager
+    def exclusive(self) -> Iterator[None]:
+        """ Hold a lock on a .lock file next to the sidecar, so one process on the host builds it at a time. """
+        if not self.path:
+            yield
+            return
+        with open(f"{self.path}.lock", "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _mtime(self) -> Optional[int]:
+        if not self.path:
+            return None
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
@@ -0,0 +1,104 @@
+import json
+import threading
+from bisect import bisect_left, insort
+from typing import Iterable, Optional
+
+from models import PineconeVector
+from .sidecar import Sidecar
+
+
+class TimestampIndex:
+    """ Sorted Updated/Created timestamps keyed by FullIdent, persisted to a local sidecar file. """
+    FIELDS = ("Updated", "Created")
+    path: Optional[str]
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: dict[str, tuple[int, int]] = {}
+        self._sorted: dict[str, list[tuple[int, str]]] = {field: [] for field in self.FIELDS}
+        self._sidecar = Sidecar(path)
+
+        if path:
+            self._reload_if_changed()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def update(self, vectors: list[PineconeVector], persist: bool = True):
+        """ Record the timestamps of upserted vectors. """
+        with self._lock:
+            # Inserting one at a time is O(n) per item, so large batches are cheaper to re-sort.
+            incremental = len(vectors) < len(self._entries) // 10
+            for vector in vectors:
+                timestamps = (int(vector.metadata["Updated"]), int(vector.metadata["Created"]))
+                previous = self._entries.get(vector.id)
+                if previous == timestamps:
+                    continue
+                self._entries[vector.id] = timestamps
+                if not incremental:
+                    continue
+
+                for i, field in enumerate(self.FIELDS):
+                    entries = self._sorted[field]
+                    if previous is not None:
+                        del entries[bisect_left(entries, (previous[i], vector.id))]
+                    insort(entries, (timestamps[i], vector.id))
+
+            if not incremental:
+                self._rebuild_sorted()
+
+        if persist:
+            self.save()
+
+    def _rebuild_sorted(self):
+        for i, field in enumerate(self.FIELDS):
+            self._sorted[field] = sorted((timestamps[i], ident) for ident, timestamps in self._entries.items())
+
+    def replace(self, batches: Iterable[list[PineconeVector]]):
+        """ Rebuild from every vector in batches. Readers keep the old entries until the new ones are swapped in whole. """
+        entries = {}
+        for vectors in batches:
+            for vector in vectors:
+                entries[vector.id] = (int(vector.metadata["Updated"]), int(vector.metadata["Created"]))
+
+        with self._lock:
+            self._entries = entries
+            self._rebuild_sorted()
+        self.save()
+
+    def newest(self, field: str, take: int) -> list[PineconeVector]:
+        """ The take most recent packages by field, newest first. """
+        self._reload_if_changed()
+        with self._lock:
+            newest = self._sorted[field][-take:] if take > 0 else []
+            return [PineconeVector(
+                id=ident,
+                values=[],
+                metadata={
+                    "FullIdent": ident,
+                    "Updated": self._entries[ident][0],
+                    "Created": self._entries[ident][1]
+                }
+            ) for _, ident in reversed(newest)]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._rebuild_sorted()
+        self.save()
+
+    def save(self):
+        """ Write the timestamps to the sidecar as JSON. """
+        with self._lock:
+            self._sidecar.write(lambda f: json.dump(self._entries, f), mode="w")
+
+    def _reload_if_changed(self):
+        self._sidecar.reload_if_changed(self._load)
+
+    def _load(self, path: str):
+        with open(path) as f:
+            entries = {ident: tuple(timestamps) for ident, timestamps in json.load(f).items()}
+        with self._lock:
+            self._entries = entries
+            self._rebuild_sorted()
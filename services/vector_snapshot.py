@@ -0,0 +1,258 @@
+import json
+import os
+import struct
+from typing import Iterator, Optional, Sequence
+
+import numpy as np
+
+from models import PineconeVector
+from .quantization import Int8Quantizer, ProductQuantizer, fit_sample, load_quantizer
+
+# File layout (all offsets in the footer header are absolute):
+#   MAGIC, padded to ALIGNMENT
+#   vector block   count x dimension, row-major, float32 or float16, unit-normalised
+#   codes block    optional (version 2): count x code_size quantized rows, int8 or uint8
+#   params block   optional (version 2): the quantizer's float32 scales or centroids
+#   Updated block  int64[count]
+#   Created block  int64[count]
+#   metadata block UTF-8 JSON {"ids": [...], "columns": {field: [...]}}
+#   header         UTF-8 JSON, then uint64 header length, then MAGIC
+# The header lives at the end so vectors can be streamed in without knowing the count up front.
+MAGIC = b"SBXVEC\x00\x01"
+ALIGNMENT = 64
+FORMAT_VERSION = 2
+SUPPORTED_VERSIONS = (1, 2)
+TIMESTAMP_FIELDS = ("Updated", "Created")
+STRING_FIELDS = ("Title", "FullIdent", "Tags", "Summary", "Type", "Thumb")
+
+
+class VectorSnapshot:
+    """ Read-only view of a snapshot file with the vector block memory-mapped. """
+    path: str
+    header: dict
+    ids: list[str]
+    vectors: np.ndarray
+    codes: Optional[np.ndarray]
+    quantizer: Optional[Int8Quantizer | ProductQuantizer]
+    columns: dict
+
+    def __init__(self, path: str):
+        self.path = path
+        self.header = self._read_header(path)
+        if self.header.get("version") not in SUPPORTED_VERSIONS:
+            raise ValueError(f"Unsupported snapshot version {self.header.get('version')} in {path}")
+
+        count, dimension = self.count, self.dimension
+        # Read-only maps share page cache between every worker that opens the same file.
+        self.vectors = np.memmap(path, dtype=self.header["dtype"], mode="r",
+                                 offset=self.header["vectors_offset"], shape=(count, dimension)) \
+            if count else np.zeros((0, dimension), dtype=self.header["dtype"])
+
+        self.codes = None
+        self.quantizer = None
+        quantization = self.header.get("quantization")
+        if quantization and count:
+            params = np.fromfile(path, dtype=np.float32, offset=quantization["params_offset"],
+                                 count=int(np.prod(quantization["params_shape"])))
+            self.quantizer = load_quantizer(quantization["kind"], params.reshape(quantization["params_shape"]))
+            self.codes = np.memmap(path, dtype=quantization["codes_dtype"], mode="r",
+                                   offset=quantization["codes_offset"], shape=(count, quantization["code_size"]))
+
+        self.columns = {}
+        for field in TIMESTAMP_FIELDS:
+            offset = self.header["timestamp_offsets"][field]
+            self.columns[field] = np.memmap(path, dtype=np.int64, mode="r", offset=offset, shape=(count,)) \
+                if count else np.zeros(0, dtype=np.int64)
+
+        with open(path, "rb") as f:
+            f.seek(self.header["metadata_offset"])
+            metadata = json.loads(f.read(self.header["metadata_length"]))
+        self.ids = metadata["ids"]
+        self.columns.update(metadata["columns"])
+
+    @staticmethod
+    def _read_header(path: str) -> dict:
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a vector snapshot")
+            f.seek(-(8 + len(MAGIC)), os.SEEK_END)
+            (header_length,) = struct.unpack("<Q", f.read(8))
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is truncated")
+            f.seek(-(8 + len(MAGIC) + header_length), os.SEEK_END)
+            return json.loads(f.read(header_length))
+
+    @property
+    def model(self) -> Optional[str]:
+        return self.header.get("model")
+
+    @property
+    def dimension(self) -> int:
+        return self.header["dimension"]
+
+    @property
+    def count(self) -> int:
+        return self.header["count"]
+
+    @property
+    def quantization(self) -> Optional[str]:
+        return self.quantizer.kind if self.quantizer else None
+
+    def metadata(self, row: int) -> dict:
+        return {field: int(self.columns[field][row]) if field in TIMESTAMP_FIELDS else self.columns[field][row]
+                for field in STRING_FIELDS + TIMESTAMP_FIELDS}
+
+    def iter_vectors(self, batch_size: int = 100, offset: int = 0) -> Iterator[list[PineconeVector]]:
+        """ Yield the snapshot as batches of PineconeVector from row offset on, e.g. for upserting. """
+        for start in range(offset, self.count, batch_size):
+            stop = min(start + batch_size, self.count)
+            block = np.asarray(self.vectors[start:stop], dtype=np.float32)
+            yield [PineconeVector(id=self.ids[row], values=block[row - start].tolist(), metadata=self.metadata(row))
+                   for row in range(start, stop)]
+
+
+class SnapshotWriter:
+    """ Streams vectors into a new snapshot file, atomically replacing path on close().
+
+    With a quantizer, close() also writes every row's codes, fitting the quantizer first if it is not yet fitted.
+    """
+    path: str
+    model: Optional[str]
+    dimension: int
+    dtype: str
+    quantizer: Optional[Int8Quantizer | ProductQuantizer]
+
+    def __init__(self,
+                 path: str,
+                 model: Optional[str],
+                 dimension: int,
+                 dtype: str = "float32",
+                 quantizer: Optional[Int8Quantizer | ProductQuantizer] = None):
+        if dtype not in ("float32", "float16"):
+            raise ValueError("Snapshot dtype must be float32 or float16")
+
+        self.path = path
+        self.model = model
+        self.dimension = dimension
+        self.dtype = dtype
+        self.quantizer = quantizer
+        self._tmp_path = f"{path}.tmp.{os.getpid()}"
+        self._file = open(self._tmp_path, "wb")
+        self._file.write(MAGIC.ljust(ALIGNMENT, b"\x00"))
+        self._ids: list[str] = []
+        self._columns = {field: [] for field in STRING_FIELDS + TIMESTAMP_FIELDS}
+
+    def __enter__(self) -> "SnapshotWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+            os.remove(self._tmp_path)
+
+    def write(self, vectors: list[PineconeVector]):
+        if not vectors:
+            return
+        self.write_arrays(
+            [vector.id for vector in vectors],
+            np.asarray([vector.values for vector in vectors], dtype=np.float32),
+            [vector.metadata for vector in vectors]
+        )
+
+    def write_arrays(self, ids: list[str], vectors: np.ndarray, metadata: list[dict]):
+        """ Append a block of rows; vectors are normalised before being written. """
+        self.write_columns(ids, vectors, {
+            field: [item.get(field, 0 if field in TIMESTAMP_FIELDS else None) for item in metadata]
+            for field in self._columns
+        })
+
+    def write_columns(self, ids: list[str], vectors: np.ndarray, columns: dict[str, Sequence]):
+        """ write_arrays with metadata given column-wise, as the local index holds it. """
+        if vectors.shape[1] != self.dimension:
+            raise ValueError(f"Vector dimension {vectors.shape[1]} does not match snapshot dimension {self.dimension}")
+
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        self._file.write(np.ascontiguousarray(vectors / norms, dtype=self.dtype).tobytes())
+
+        self._ids.extend(ids)
+        for field, column in self._columns.items():
+            if field in columns:
+                column.extend(columns[field])
+            else:
+                column.extend([0 if field in TIMESTAMP_FIELDS else None] * len(ids))
+
+    def _align(self):
+        padding = -self._file.tell() % ALIGNMENT
+        self._file.write(b"\x00" * padding)
+
+    def _write_quantization(self, count: int) -> Optional[dict]:
+        """ Encode the vector block already on disk in chunks, so it never has to be held in memory at once. """
+        if self.quantizer is None or not count:
+            return None
+
+        self._file.flush()
+        vectors = np.memmap(self._tmp_path, dtype=self.dtype, mode="r", offset=ALIGNMENT, shape=(count, self.dimension))
+        if self.quantizer.params is None:
+            self.quantizer.fit(fit_sample(vectors))
+
+        self._align()
+        codes_offset = self._file.tell()
+        codes_dtype = None
+        for start in range(0, count, 10000):
+            codes = self.quantizer.encode(vectors[start:start+10000])
+            codes_dtype = codes.dtype.name
+            self._file.write(codes.tobytes())
+        del vectors
+
+        self._align()
+        params_offset = self._file.tell()
+        params = np.ascontiguousarray(self.quantizer.params, dtype=np.float32)
+        self._file.write(params.tobytes())
+        return {
+            "kind": self.quantizer.kind,
+            "code_size": self.quantizer.code_size,
+            "codes_dtype": codes_dtype,
+            "codes_offset": codes_offset,
+            "params_offset": params_offset,
+            "params_shape": list(params.shape)
+        }
+
+    def close(self):
+        count = len(self._ids)
+        quantization = self._write_quantization(count)
+        self._align()
+        timestamp_offsets = {}
+        for field in TIMESTAMP_FIELDS:
+            timestamp_offsets[field] = self._file.tell()
+            self._file.write(np.asarray(self._columns[field], dtype=np.int64).tobytes())
+            self._align()
+
+        metadata_offset = self._file.tell()
+        metadata = json.dumps({
+            "ids": self._ids,
+            "columns": {field: self._columns[field] for field in STRING_FIELDS}
+        }).encode("utf-8")
+        self._file.write(metadata)
+
+        header = json.dumps({
+            "version": FORMAT_VERSION,
+            "model": self.model,
+            "dimension": self.dimension,
+            "dtype": self.dtype,
+            "count": count,
+            "normalized": True,
+            "vectors_offset": ALIGNMENT,
+            "timestamp_offsets": timestamp_offsets,
+            "metadata_offset": metadata_offset,
+            "metadata_length": len(metadata),
+            "quantization": quantization
+        }).encode("utf-8")
+        self._file.write(header)
+        self._file.write(struct.pack("<Q", len(header)))
+        self._file.write(MAGIC)
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
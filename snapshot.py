@@ -0,0 +1,191 @@
+import argparse
+import os
+import time
+from typing import Optional
+import numpy as np
+from dotenv import load_dotenv
+from services import LocalVectorService, SnapshotWriter, VectorSnapshot
+from services.quantization import create_quantizer, fit_sample
+from dependencies import get_embedding_model_key, get_pinecone_service
+
+load_dotenv()
+
+
+def export_snapshot(path: str, dtype: str, quantization: Optional[str]):
+    """ Stream every vector out of the configured index into a snapshot file. """
+    service = get_pinecone_service()
+    model = get_embedding_model_key()
+    writer = None
+    count = 0
+    start = time.perf_counter()
+
+    for batch in service.iter_vectors():
+        if not batch:
+            continue
+        if writer is None:
+            quantizer = create_quantizer(quantization) if quantization else None
+            writer = SnapshotWriter(path, model, len(batch[0].values), dtype, quantizer)
+        writer.write(batch)
+        count += len(batch)
+        print(f"Exported {count} vectors", end="\r")
+
+    if writer is None:
+        print("Index is empty, nothing to export")
+        return
+
+    writer.close()
+    print(f"Exported {count} vectors to {path} in {time.perf_counter() - start:.1f}s")
+
+
+IMPORT_CHUNK_SIZE = 2000
+
+
+def import_snapshot(path: str, force: bool, resume: bool):
+    """ Upsert every vector in a snapshot file into the configured index.
+
+    Rows are sent in chunks that the service upserts concurrently, and the number of rows acknowledged so far
+    is recorded next to the snapshot so an interrupted import can continue with --resume. """
+    snapshot = VectorSnapshot(path)
+    model = get_embedding_model_key()
+    if model and snapshot.model != model and not force:
+        raise SystemExit(f"Snapshot was built with {snapshot.model} but EMBEDDING_MODEL/EMBEDDING_DIMENSIONS give {model}, pass --force to import anyway")
+
+    service = get_pinecone_service()
+    start = time.perf_counter()
+
+    if isinstance(service, LocalVectorService):
+        service.load_snapshot(snapshot)
+        if service.path:
+            service.save()
+    else:
+        progress_path = f"{path}.import-progress"
+        count = 0
+        if resume and os.path.exists(progress_path):
+            with open(progress_path) as f:
+                count = int(f.read().strip() or 0)
+            print(f"Resuming after {count} acknowledged vectors")
+        for batch in snapshot.iter_vectors(IMPORT_CHUNK_SIZE, offset=count):
+            service.upsert_embeddings(batch)
+            count += len(batch)
+            with open(progress_path, "w") as f:
+                f.write(str(count))
+            print(f"Imported {count}/{snapshot.count} vectors", end="\r")
+        if os.path.exists(progress_path):
+            os.remove(progress_path)
+
+    print(f"Imported {snapshot.count} vectors from {path} in {time.perf_counter() - start:.1f}s")
+
+
+def print_info(path: str):
+    start = time.perf_counter()
+    snapshot = VectorSnapshot(path)
+    elapsed = (time.perf_counter() - start) * 1000
+    for key in ("version", "model", "dimension", "dtype", "count"):
+        print(f"{key}: {snapshot.header[key]}")
+    print(f"quantization: {snapshot.quantization}")
+    print(f"opened in {elapsed:.1f}ms")
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return (vectors / norms).astype(np.float32)
+
+
+def report_recall(path: str,
+                  quantization: Optional[str],
+                  prefix_dimensions: Optional[int],
+                  k: int,
+                  queries: int,
+                  rerank_factor: int,
+                  seed: int):
+    """ Compare two-stage search (quantized codes and/or a dimension prefix, then exact re-rank) against exact
+    float search over a snapshot, using sampled rows as queries. """
+    snapshot = VectorSnapshot(path)
+    vectors = np.asarray(snapshot.vectors, dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    # Perturbed corpus rows stand in for queries: close to real neighbourhoods but never an exact match.
+    picks = vectors[rng.choice(len(vectors), min(queries, len(vectors)), replace=False)]
+    noise = rng.standard_normal(picks.shape).astype(np.float32) * 0.5 / np.sqrt(vectors.shape[1])
+    query_block = normalize_rows(picks + noise)
+
+    coarse_vectors = normalize_rows(vectors[:, :prefix_dimensions]) if prefix_dimensions else vectors
+    coarse_queries = normalize_rows(query_block[:, :prefix_dimensions]) if prefix_dimensions else query_block
+    quantizer = codes = None
+    if quantization and snapshot.quantization == quantization and not prefix_dimensions:
+        quantizer, codes = snapshot.quantizer, np.asarray(snapshot.codes)
+        print(f"Using the {quantization} codes stored in the snapshot")
+    elif quantization:
+        start = time.perf_counter()
+        quantizer = create_quantizer(quantization).fit(fit_sample(coarse_vectors, seed))
+        codes = quantizer.encode(coarse_vectors)
+        print(f"Fitted and encoded {quantization} codes in {time.perf_counter() - start:.1f}s")
+
+    exact_seconds = coarse_seconds = rerank_seconds = 0.0
+    recall = reranked_recall = 0.0
+    for query, coarse_query in zip(query_block, coarse_queries):
+        start = time.perf_counter()
+        expected = set(np.argpartition(-(vectors @ query), k)[:k].tolist())
+        exact_seconds += time.perf_counter() - start
+
+        start = time.perf_counter()
+        scores = quantizer.scores(coarse_query, codes) if quantizer else coarse_vectors @ coarse_query
+        candidates = np.argpartition(-scores, k * rerank_factor)[:k * rerank_factor]
+        coarse = candidates[np.argsort(-scores[candidates])][:k]
+        coarse_seconds += time.perf_counter() - start
+
+        start = time.perf_counter()
+        candidates = np.sort(candidates)
+        reranked = candidates[np.argsort(-(vectors[candidates] @ query))][:k]
+        rerank_seconds += time.perf_counter() - start
+
+        recall += len(expected.intersection(coarse.tolist())) / k
+        reranked_recall += len(expected.intersection(reranked.tolist())) / k
+
+    count = len(query_block)
+    stage = " + ".join(filter(None, [quantization, f"{prefix_dimensions}-dim prefix" if prefix_dimensions else None]))
+    coarse_bytes = codes.shape[1] * codes.itemsize if codes is not None else coarse_vectors.shape[1] * 4
+    print(f"vectors: {len(vectors)} x {vectors.shape[1]}, coarse stage: {stage or 'float32'}")
+    print(f"bytes per vector: float32 {vectors.shape[1] * 4}, coarse {coarse_bytes}")
+    print(f"recall@{k}: {recall / count:.3f} coarse, {reranked_recall / count:.3f} with x{rerank_factor} exact re-rank")
+    print(f"ms per query: exact {exact_seconds / count * 1000:.2f}, coarse {coarse_seconds / count * 1000:.2f} "
+          f"+ re-rank {rerank_seconds / count * 1000:.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export, import and inspect package vector snapshots.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="Write the configured index to a snapshot file")
+    export_parser.add_argument("path")
+    export_parser.add_argument("--float16", action="store_true", help="Store vectors as float16 to halve the file size")
+    export_parser.add_argument("--quantization", choices=("int8", "pq"),
+                               help="Also store quantized codes, so a quantized local index starts without re-encoding")
+
+    import_parser = commands.add_parser("import", help="Load a snapshot file into the configured index")
+    import_parser.add_argument("path")
+    import_parser.add_argument("--force", action="store_true", help="Import even if the embedding model differs")
+    import_parser.add_argument("--resume", action="store_true", help="Continue an interrupted import where it stopped")
+
+    info_parser = commands.add_parser("info", help="Print a snapshot's header")
+    info_parser.add_argument("path")
+
+    recall_parser = commands.add_parser("recall", help="Report two-stage search recall against exact float search")
+    recall_parser.add_argument("path")
+    recall_parser.add_argument("--quantization", choices=("int8", "pq", "none"), default="int8")
+    recall_parser.add_argument("--prefix-dimensions", type=int, help="Score the coarse stage on this many leading dimensions")
+    recall_parser.add_argument("--k", type=int, default=10)
+    recall_parser.add_argument("--queries", type=int, default=200)
+    recall_parser.add_argument("--rerank-factor", type=int, default=4)
+    recall_parser.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+    if args.command == "export":
+        export_snapshot(args.path, "float16" if args.float16 else "float32", args.quantization)
+    elif args.command == "import":
+        import_snapshot(args.path, args.force, args.resume)
+    elif args.command == "recall":
+        quantization = None if args.quantization == "none" else args.quantization
+        report_recall(args.path, quantization, args.prefix_dimensions, args.k, args.queries, args.rerank_factor, args.seed)
+    else:
+        print_info(args.path)
@@ -1,4 +1,5 @@
 from datetime import datetime
+from typing import Optional
 from dateutil import parser
 from models import PineconeVector
 
@@ -8,6 +9,28 @@ def to_timestamp(date_str: str) -> int:
 def from_timestamp(timestamp: int) -> str:
     return datetime.fromtimestamp(timestamp).isoformat()
 
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
+def embedding_model_key(model: str, dimensions: Optional[int] = None) -> str:
+    """ Identity of an embedding space for cache keys and snapshots: shortened embeddings aren't interchangeable. """
+    return f"{model}:{dimensions}" if dimensions else model
+
+def apportion_tokens(texts: list[str], tokens: int) -> list[int]:
+    """ Split a batch's token count across its texts by length, as the embeddings API only reports the total. """
+    total_length = sum(len(text) for text in texts) or 1
+    return [round(tokens * len(text) / total_length) for text in texts]
+
+def reciprocal_rank_fusion(rankings: list[list[dict]], k: int = 60) -> list[dict]:
+    """ Merge ranked {"id", ...} lists by summed 1 / (k + rank), best first. """
+    scores = {}
+    matches = {}
+    for ranking in rankings:
+        for rank, match in enumerate(ranking):
+            scores[match["id"]] = scores.get(match["id"], 0.0) + 1 / (k + rank + 1)
+            matches.setdefault(match["id"], match)
+    return [matches[ident] for ident in sorted(scores, key=scores.get, reverse=True)]
+
 def get_embed_string(package: dict) -> str:
     string = "Title:" + package['Title']
     if package['Summary']:
@@ -16,6 +39,18 @@ def get_embed_string(package: dict) -> str:
         string += ", Tags:" + ", ".join(package["Tags"])
     return string
 
+def get_pinecone_metadata_from_package(facepunch_package: dict) -> dict:
+    return {
+        "Title": facepunch_package["Title"],
+        "FullIdent": facepunch_package["FullIdent"],
+        "Tags": facepunch_package["Tags"],
+        "Summary": facepunch_package["Summary"],
+        "Type": facepunch_package["TypeName"],
+        "Thumb": facepunch_package["Thumb"],
+        "Updated": to_timestamp(facepunch_package["Updated"]),
+        "Created": to_timestamp(facepunch_package["Created"])
+    }
+
 def get_pinecone_vector_from_package(
     embedding: list[float],
     facepunch_package: dict
@@ -23,14 +58,5 @@ def get_pinecone_vector_from_package(
     return PineconeVector(
         id=facepunch_package["FullIdent"],
         values=embedding,
-        metadata={
-            "Title": facepunch_package["Title"],
-            "FullIdent": facepunch_package["FullIdent"],
-            "Tags": facepunch_package["Tags"],
-            "Summary": facepunch_package["Summary"],
-            "Type": facepunch_package["TypeName"],
-            "Thumb": facepunch_package["Thumb"],
-            "Updated": to_timestamp(facepunch_package["Updated"]),
-            "Created": to_timestamp(facepunch_package["Created"])
-        }
+        metadata=get_pinecone_metadata_from_package(facepunch_package)
     )
\ No newline at end of file